@@ -11,22 +11,23 @@ client = None
 
 def get_client(state, force=False):
     global client
-    if client is None or force:
-        client = atproto.Client()
+    with core.lock('bluesky', 'client'):
+        if client is None or force:
+            client = atproto.Client()
 
-        if ('bluesky', 'session') in state and not force:
-            client.login(session_string = state['bluesky', 'session'])
-        else:
-            username = input("Enter bluesky username: ")
-            password = getpass.getpass()
-            client.login(login=username, password=password)
+            if ('bluesky', 'session') in state and not force:
+                client.login(session_string = state['bluesky', 'session'])
+            else:
+                username = input("Enter bluesky username: ")
+                password = getpass.getpass()
+                client.login(login=username, password=password)
 
-        def on_session_change(event, session):
-            state['bluesky', 'session'] = session.export()
+            def on_session_change(event, session):
+                state['bluesky', 'session'] = session.export()
 
-        client.on_session_change(on_session_change)
-        state['bluesky', 'session'] = client.export_session_string()
-    return client
+            client.on_session_change(on_session_change)
+            state['bluesky', 'session'] = client.export_session_string()
+        return client
 
 def to_json(obj):
     if type(obj) is list:
@@ -79,7 +80,7 @@ def account_name(acct, full=False, escape=True):
 
 def smolname(author):
     if author.get('avatar'):
-        return f'<img src="{author['avatar']}" width=16 height=16> {account_name(author)}'
+        return f'<img src="{html.escape(author['avatar'])}" width=16 height=16> {account_name(author)}'
     return account_name(author)
 
 def post_to_html(entry, doc, line, state, url):
@@ -93,7 +94,7 @@ def post_to_html(entry, doc, line, state, url):
                 html_parts.append(f'''<p>{smolname(entry['reason']['by'])} reposted:</p>''')
 
         if entry.get('reply') and entry['reply'].get('parent') and entry['reply']['parent'].get('author'):
-            html_parts.append(f'''<details><summary><a href="{uri_to_https(entry['reply']['parent']['uri'])}">In reply to</a> {smolname(entry['reply']['parent']['author'])}</summary><blockquote>{post_to_html(entry['reply']['parent'], doc, line, state, url)}</blockquote></details>''')
+            html_parts.append(f'''<details><summary><a href="{html.escape(uri_to_https(entry['reply']['parent']['uri']))}">In reply to</a> {smolname(entry['reply']['parent']['author'])}</summary><blockquote>{post_to_html(entry['reply']['parent'], doc, line, state, url)}</blockquote></details>''')
 
         if entry.get('post'):
             html_parts.append(post_to_html(entry['post'], doc, line, state, url))
@@ -126,13 +127,13 @@ def post_to_html(entry, doc, line, state, url):
         url = uri_to_https(entry['uri'])
 
         if entry.get('value'):
-            html_parts.append(f'''<p><a href="{uri_to_https(entry['uri'])}">Embedded post</a> by {smolname(entry['author'])}</p>''')
+            html_parts.append(f'''<p><a href="{html.escape(uri_to_https(entry['uri']))}">Embedded post</a> by {smolname(entry['author'])}</p>''')
             html_parts.append(f'''<blockquote style="white-space: pre-wrap;">{post_to_html(entry['value'], doc, line, state, url)}</blockquote>''')
     elif entry['py_type'] == 'app.bsky.embed.images#view':
         for image in entry['images']:
             html_parts.append(post_to_html(image, doc, line, state, url))
     elif entry['py_type'] == 'app.bsky.embed.images#viewImage':
-        html_parts.append(f'''<p><a href="{entry['fullsize']}"><img src="{entry['thumb']}" style="max-height: 100vh; max-width: 100vw"></a></p>''')
+        html_parts.append(f'''<p><a href="{html.escape(entry['fullsize'])}"><img src="{html.escape(entry['thumb'])}" style="max-height: 100vh; max-width: 100vw"></a></p>''')
 
         if entry.get('alt'):
             html_parts.append(f'''<p style="white-space: pre-wrap;">Image description: {html.escape(entry['alt'])}</p>''')
@@ -145,9 +146,9 @@ def post_to_html(entry, doc, line, state, url):
     elif entry['py_type'] == 'app.bsky.embed.external#view':
         html_parts.append(post_to_html(entry['external'], doc, line, state, url))
     elif entry['py_type'] == 'app.bsky.embed.external#viewExternal':
-        html_parts.append(f'''<p><a href="{entry['uri']}">{html.escape(entry.get('title', 'Link embed:'))}</a></p>''')
+        html_parts.append(f'''<p><a href="{html.escape(entry['uri'])}">{html.escape(entry.get('title', 'Link embed:'))}</a></p>''')
         if entry.get('thumb'):
-            html_parts.append(f'''<p><img src="{entry['thumb']}" style="max-height: 100vh; max-width: 100vw"></p>''')
+            html_parts.append(f'''<p><img src="{html.escape(entry['thumb'])}" style="max-height: 100vh; max-width: 100vw"></p>''')
         if entry.get('description'):
             html_parts.append(f'''<p style="white-space: pre-wrap;">Description: {html.escape(entry['description'])}</p>''')
     elif entry['py_type'] == 'app.bsky.embed.recordWithMedia#view':
@@ -156,9 +157,9 @@ def post_to_html(entry, doc, line, state, url):
     elif entry['py_type'] == 'app.bsky.embed.video#view':
         # can't embed an m3u8 with pure HTML, so just put in the video thumbnail
         html_parts.append('<p>[video]</p>')
-        html_parts.append(f'''<p><a href="{url}"><img src="{entry['thumbnail']}" style="max-height: 100vh; max-width: 100vw"></a></p>''')
+        html_parts.append(f'''<p><a href="{html.escape(url)}"><img src="{html.escape(entry['thumbnail'])}" style="max-height: 100vh; max-width: 100vw"></a></p>''')
     elif entry['py_type'] == 'app.bsky.graph.defs#starterPackViewBasic':
-        html_parts.append(f'''<p>Embedded <a href="{uri_to_https(entry['uri'])}">starter pack</a> by {smolname(entry['creator'])}</p>''')
+        html_parts.append(f'''<p>Embedded <a href="{html.escape(uri_to_https(entry['uri']))}">starter pack</a> by {smolname(entry['creator'])}</p>''')
         if entry.get('record'):
             html_parts.append(post_to_html(entry['record'], doc, line, state, url))
     elif entry['py_type'] == 'app.bsky.graph.starterpack':
@@ -167,7 +168,7 @@ def post_to_html(entry, doc, line, state, url):
         if entry.get('description'):
             html_parts.append(f'''<p style="white-space: pre-wrap;">{html.escape(entry['description'])}</p>''')
     elif entry['py_type'] == 'app.bsky.feed.defs#generatorView':
-        html_parts.append(f'''<p>Embedded <a href="{uri_to_https(entry['uri'])}>feed</a> by {smolname(entry['creator'])}:</p>''')
+        html_parts.append(f'''<p>Embedded <a href="{html.escape(uri_to_https(entry['uri']))}">feed</a> by {smolname(entry['creator'])}:</p>''')
         if entry.get('display_name'):
             html_parts.append(f'''<p>{html.escape(entry['display_name'])}</p>''')
         if entry.get('description'):
@@ -186,6 +187,7 @@ def translate_entry(entry, doc, line, state):
             entry['fm:avatar'] = post['author']['avatar']
         entry['fm:timestamp'] = post['record']['created_at']
         entry['fm:html'] = post_to_html(entry, doc, line, state, entry['fm:link'])
+        entry['fm:html_trusted'] = True
     elif entry['py_type'] == 'app.bsky.notification.listNotifications#notification':
         entry['fm:author'] = account_name(entry['author'], full=True, escape=False)
         if entry['author'].get('avatar'):
@@ -208,6 +210,7 @@ def translate_entry(entry, doc, line, state):
             entry['fm:title'] = "Replied to your post"
             if entry.get('record'):
                 entry['fm:html'] = post_to_html(entry['record'], doc, line, state, entry['fm:link'])
+                entry['fm:html_trusted'] = True
         elif reason == 'quote':
             entry['fm:title'] = "Quoted your post"
         else:
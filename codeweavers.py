@@ -7,21 +7,22 @@ import core
 import web
 
 def fetch(url, state):
-    headers = {}
-    headers['User-Agent'] = 'feed-merger/1.0 +https://github.com/madewokherd/feed-merger'
-    if ('codeweavers', 'token') in state:
-        headers['Cookie'] = f'cw={state['codeweavers', 'token']}'
-    js, tokens = web.fetch_html(url, headers=headers)
+    with core.lock('codeweavers', 'token'):
+        headers = {}
+        headers['User-Agent'] = 'feed-merger/1.0 +https://github.com/madewokherd/feed-merger'
+        if ('codeweavers', 'token') in state:
+            headers['Cookie'] = f'cw={state['codeweavers', 'token']}'
+        js, tokens = web.fetch_html(url, headers=headers)
 
-    if js['html:title'] == 'Sign In | CodeWeavers':
-        token = input('Enter your login token (contents of cw= cookie) for www.codeweavers.com: ')
-        if token:
-            headers['Cookie'] = f'cw={token}'
-            js, tokens = web.fetch_html(url, headers=headers)
-            if js['html:title'] == 'Sign In | CodeWeavers':
-                raise Exception("login invalid")
-            state['codeweavers', 'token'] = token
-    return js, tokens
+        if js['html:title'] == 'Sign In | CodeWeavers':
+            token = input('Enter your login token (contents of cw= cookie) for www.codeweavers.com: ')
+            if token:
+                headers['Cookie'] = f'cw={token}'
+                js, tokens = web.fetch_html(url, headers=headers)
+                if js['html:title'] == 'Sign In | CodeWeavers':
+                    raise Exception("login invalid")
+                state['codeweavers', 'token'] = token
+        return js, tokens
 
 def process(line, state):
     url = line
@@ -41,11 +42,11 @@ def process(line, state):
     for i in range(len(tokens)):
         # <link rel="shortcut icon" href="...">
         if tokens[i][0] == web.STARTTAG and tokens[i][1] == 'link':
-            attrs = dict(tokens[i][2])
+            attrs = tokens.attrs(i)
             if attrs.get('rel') in ("icon", "shortcut icon", "apple-touch-icon"):
                 favicon = attrs['href']
         # <table id="teTable">
-        elif tokens[i][0] == web.STARTTAG and tokens[i][1] == 'table' and 'teTable' in dict(tokens[i][2]).get('class', ''):
+        elif tokens[i][0] == web.STARTTAG and tokens[i][1] == 'table' and 'teTable' in tokens.attrs(i).get('class', ''):
             in_table = True
             in_header = True
             in_heading = False
@@ -70,17 +71,17 @@ def process(line, state):
             in_data = True
         # <a href="...">
         elif in_data and tokens[i][0] == web.STARTTAG and tokens[i][1] == 'a':
-            attrs = dict(tokens[i][2])
+            attrs = tokens.attrs(i)
             if 'href' in attrs:
                 entry[f'codeweavers:link:{columns[data_index]}'] = urllib.parse.urljoin(url, attrs['href'])
         # <img src="...">
         elif in_data and tokens[i][0] == web.STARTTAG and tokens[i][1] == 'img':
-            attrs = dict(tokens[i][2])
+            attrs = tokens.attrs(i)
             if 'src' in attrs:
                 entry[f'codeweavers:img:{columns[data_index]}'] = urllib.parse.urljoin(url, attrs['src'])
         # <span class="cust-level">
         elif in_data and tokens[i][0] == web.STARTTAG and tokens[i][1] == 'span':
-            attrs = dict(tokens[i][2])
+            attrs = tokens.attrs(i)
             if 'cust-level' in attrs.get('class', ''):
                 in_level = True
         # </span>
@@ -1,6 +1,45 @@
 
+import threading
+import time
+
 # disposition values
 SUCCESS = 'SUCCESS' # successfully handled, no data returned
 REDIRECT = 'REDIRECT' # redirected to another resouece
 JSON = 'JSON' # json data returned
 UNHANDLED = 'UNHANDLED' # fall back on parent
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def lock(*key):
+    # returns the same lock for every caller using the same key, so shared
+    # caches and interactive logins can be guarded when lines run concurrently
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = threading.RLock()
+        return _locks[key]
+
+# how long favicon lookups are remembered across runs
+FAVICON_TTL = 7 * 24 * 60 * 60
+FAVICON_MISS_TTL = 24 * 60 * 60
+
+# how long what find_avatars found for an author is remembered
+AUTHOR_TTL = 7 * 24 * 60 * 60
+AUTHOR_MISS_TTL = 24 * 60 * 60
+
+def get_expiring(state, key, ttl, miss_ttl):
+    # looks up a (value, time checked) pair stored by set_expiring, returns
+    # (found, value) where misses are cached as a value of None
+    if state is None:
+        return False, None
+    cached = state.get(key)
+    if cached is None:
+        return False, None
+    value, checked = cached
+    if time.time() - checked > (ttl if value is not None else miss_ttl):
+        return False, None
+    return True, value
+
+def set_expiring(state, key, value):
+    if state is not None:
+        state[key] = (value, time.time())
@@ -1,274 +1,114 @@
 #!/usr/bin/env python
 
+import argparse
+import concurrent.futures
 import datetime
 import html
-import html.parser
 import json
+import multiprocessing
 import os
 import os.path
 import readline
 import sys
+import time
 import traceback
 import urllib.parse
 
 import core
-
-entry_template = """<h1><a name="item{e['fm:counter']}"></a><?if e.get('fm:link')><a href="{e['fm:link']}"><?endif><?if e.get('fm:avatar')><img src="{e['fm:avatar']}" height=48><?endif>{' - '.join(x for x in (e.get('fm:feedname') or f.get('fm:title'), e.get('fm:author'), e.get('fm:title')) if x) or e.get('fm:source')}<?if e.get('fm:link')></a><?endif> {e['fm:timestamp']} <a href="#item{e['fm:counter']}">[anchor]</a></h1>
-
-<?html <!-->
-<?html {json.dumps(e, indent=2).replace('--' + chr(62), '--\\\\' + chr(62))}>
-<?html --{chr(62)}>
-
-<?if e.get('fm:thumbnail')><p><img src="{e['fm:thumbnail']}" height="240"></p><?endif>
-
-<?if e.get('fm:html')><?html {translate_html(f, e, e['fm:html'])}><?endif>
-"""
-
-class HtmlTemplateFiller(html.parser.HTMLParser):
-    def __init__(self, locals_dict):
-        super().__init__()
-        self.locals_dict = locals_dict
-        self.strs = []
-        self.stack = []
-        self.output_enabled = True
-
-    def get_contents(self):
-        return ''.join(self.strs)
-
-    def handle_starttag(self, tag, attrs, close=False):
-        if not self.output_enabled:
-            return
-
-        self.strs.append('<')
-        self.strs.append(tag)
-
-        for (key, value) in attrs:
-            self.strs.append(' ')
-            self.strs.append(key)
-            self.strs.append('="')
-            try:
-                self.strs.append(html.escape(str(eval(f'f"""{value}"""', globals(), self.locals_dict))))
-            except Exception as exc:
-                self.strs.append(html.escape(str(exc)))
-            self.strs.append('"')
-
-        if close:
-            self.strs.append('/>')
-        else:
-            self.strs.append('>')
-
-    def handle_endtag(self, tag):
-        if not self.output_enabled:
-            return
-
-        self.strs.append('</')
-        self.strs.append(tag)
-        self.strs.append('>')
-
-    def handle_startendtag(self, tag, attrs):
-        self.handle_starttag(tag, attrs, close=True)
-
-    def handle_data(self, data):
-        if not self.output_enabled:
+import fm_archive
+import fm_http
+import fm_output
+import fm_render
+import fm_state
+import web
+
+def render_item(entry):
+    # the counter is left as fm_render.COUNTER_SENTINEL, so the archive can
+    # keep the html and fill in a new counter each time it is used
+    return fm_render.render_cached(render_entry, template_version, entry, entry.get('fm:feed', {}), sentinel=True)
+
+def add_item(entry, item_html=None):
+    # item_html is the already rendered entry from render_item, if there is one
+    try:
+        key = fm_output.timestamp_key(entry['fm:timestamp'])
+        wanted = items.wants(key)
+        if not wanted and archive is None:
             return
-
+        if item_html is None:
+            item_html = render_item(entry)
+        if archive is not None:
+            # everything goes in the archive, even if it doesn't make the page
+            archive.add(entry, item_html, key, template_version, time.time())
+        if wanted:
+            if sidecar is not None:
+                sidecar.write(entry)
+            items.append((fm_render.with_counter(item_html, entry), entry['fm:timestamp']), key,
+                fm_output.entry_record(entry) if writers else None)
+    except:
+        print("Failed processing json")
+        print(json.dumps(entry, indent=2))
+        traceback.print_exc()
+
+def archived_html(source, id, entry, item_html, version):
+    # gives the entry a counter for this run and returns its html with it,
+    # entries rendered with another template are rendered again and updated
+    count_entry(entry)
+    if version != template_version:
         try:
-            self.strs.append(html.escape(str(eval(f'f"""{data}"""', globals(), self.locals_dict))))
-        except Exception as exc:
-            self.strs.append(html.escape(str(exc)))
-
-    def handle_pi(self, data):
-        if ' ' in data:
-            name, rest = data.split(' ', 1)
-        else:
-            name = data
-            rest = ''
-
-        if name == 'if':
-            self.stack.append(('if', self.output_enabled))
-            if self.output_enabled:
-                try:
-                    self.output_enabled = bool(eval(rest, globals(), self.locals_dict))
-                except Exception as exc:
-                    self.output_enabled = False
-                    self.strs.append(html.escape(str(exc)))
-        elif name == 'endif':
-            name, output_enabled = self.stack.pop()
-            if name != 'if':
-                raise Exception("template has <?endif> without <?if>")
-            self.output_enabled = output_enabled
-        elif name == 'html':
-            if not self.output_enabled:
-                return
-
-            try:
-                self.strs.append(str(eval(f'f"""{rest}"""', globals(), self.locals_dict)))
-            except Exception as exc:
-                self.strs.append(html.escape(str(exc)))
-        else:
-            raise Exception(f"template has unknown processing instruction {name}")
-
-def item_from_json(entry):
-    template_filler = HtmlTemplateFiller({
-        'e': entry,
-        'f': entry.get('fm:feed', {}),
-    })
-    template_filler.feed(entry_template)
-    template_filler.close()
-
-    return template_filler.get_contents(), entry['fm:timestamp']
-
-def items_from_entries(items):
-    for entry in entries:
-        try:
-            items.append(item_from_json(entry))
+            item_html = render_item(entry)
         except:
             print("Failed processing json")
             print(json.dumps(entry, indent=2))
             traceback.print_exc()
-
-_BODY_STYLES = {
-    'alink': 'div.styleID a:active { color: VAL; } ',
-    'vlink': 'div.styleID a:visited { color: VAL; } ',
-    'link': 'div.styleID a { color: VAL; } ',
-    'background': 'div.styleID { background: url("VAL"); }',
-    'bgcolor': 'div.styleID { background-color: VAL; }',
-    'bottommargin': 'div.styleID { margin-bottom: VAL; }',
-    'leftmargin': 'div.styleID { margin-left: VAL; }',
-    'topmargin': 'div.styleID { margin-top: VAL; }',
-    'rightmargin': 'div.styleID { margin-right: VAL; }',
-    'text': 'div.styleID { color: VAL; }',
-}
-
-_style_counter = 0
-
-class HtmlTranslator(html.parser.HTMLParser):
-    def __init__(self, base):
-        super().__init__()
-        self.strs = []
-        self.stack = []
-        self.base = base
-        self.location = None
-        self.output_enabled = True
-        self.in_divs = 0
-
-    def handle_starttag(self, tag, attrs):
-        body_to_div = False
-
-        if tag == 'html':
-            self.stack.append((self.location, self.output_enabled))
-            self.location = 'html'
-            self.output_enabled = False
-            return
-        if tag == 'head':
-            self.stack.append((self.location, self.output_enabled))
-            self.location = 'head'
-            self.output_enabled = False
-            return
-        if tag == 'body':
-            self.stack.append((self.location, self.output_enabled))
-            self.location = 'body'
-            self.output_enabled = True
-            tag = 'div'
-            body_to_div = True
-            style_str = []
-            global _style_counter
-            _style_counter += 1
-            style_id = _style_counter
-
-        if self.location == 'head' and tag == 'base':
-            attrs = dict(attrs)
-            if 'href' in attrs:
-                self.base = attrs['href']
-            return
-
-        if self.output_enabled:
-            if tag == 'div':
-                self.in_divs += 1
-            if not self.in_divs:
-                self.strs.append('<div>')
-                self.in_divs = 1
-            self.strs.append('<')
-            self.strs.append(tag)
-            for key, value in attrs:
-                if value and key in ('src', 'href'):
-                    value = urllib.parse.urljoin(self.base, value)
-                self.strs.append(' ')
-                self.strs.append(key)
-                if value:
-                    self.strs.append('="')
-                    self.strs.append(html.escape(value))
-                    self.strs.append('"')
-                    if body_to_div:
-                        if key in _BODY_STYLES:
-                            style_str.append(_BODY_STYLES[key].replace('VAL', value).replace('ID', str(style_id)))
-            if body_to_div and style_str:
-                self.strs.append(f' class="style{style_id}"')
-            self.strs.append('>')
-            if body_to_div and style_str:
-                self.strs.append('<style>')
-                self.strs.append(html.escape('\n'.join(style_str)))
-                self.strs.append('</style>')
-
-    def handle_endtag(self, tag):
-        output_was_enabled = self.output_enabled
-        if tag == self.location:
-            self.location, self.output_enabled = self.stack.pop()
-
-        if tag == 'body':
-            tag = 'div'
-
-        if output_was_enabled:
-            if tag == 'div':
-                if self.in_divs:
-                    self.in_divs -= 1
-                else:
-                    return
-            self.strs.append('</')
-            self.strs.append(tag)
-            self.strs.append('>')
-
-    def handle_data(self, data):
-        if self.output_enabled:
-            self.strs.append(html.escape(data))
-
-    def get_contents(self):
-        while self.in_divs:
-            self.in_divs -= 1
-            self.strs.append('</div>')
-        return ''.join(self.strs)
-
-def translate_html(feed, entry, data):
-    parser = HtmlTranslator(entry.get('fm:base', feed.get('fm:base', '')))
-    parser.feed(data)
-    return parser.get_contents()
-
-def handle_line(line):
-    global entries
+            return None
+        archive.update_html(source, id, item_html, template_version)
+    return fm_render.with_counter(item_html, entry)
+
+def rebuild_from_archive():
+    # per day pages want every entry, otherwise only what can make the page is read
+    if args.per_day_pages:
+        rows = archive.entries()
+    else:
+        rows = archive.entries(args.newest, since)
+    for count, (source, id, timestamp, key, entry, item_html, version) in enumerate(rows):
+        if not items.wants(key):
+            continue
+        item_html = archived_html(source, id, entry, item_html, version)
+        if item_html is not None:
+            if sidecar is not None:
+                sidecar.write(entry)
+            items.append((item_html, timestamp), key, fm_output.entry_record(entry) if writers else None)
+        if count % 1000 == 999:
+            items.end_run()
+    items.end_run()
+
+def handle_line(line, owner=None):
+    # owner is the line from the feed list, when following a redirect
+    line_state = fm_state.LineState(state, owner or line)
     if line.startswith('mastodon:'):
         import mastodon
-        return mastodon.process(line, state)
+        return mastodon.process(line, line_state)
     elif line.startswith('gmail:'):
         import gmail
-        return gmail.process(line, state)
+        return gmail.process(line, line_state)
     elif line.startswith('nebula:'):
         import nebula
-        return nebula.process(line, state, items)
+        return nebula.process(line, line_state, items)
     elif line.startswith(('github-branch:', 'github-issue-search')):
         import github
-        return github.process(line, state, items)
+        return github.process(line, line_state, items)
     elif line.startswith(('gitlab-branch:', 'gitlab-projects:', 'gitlab-mirror-push-failures:')):
         import gitlab
-        return gitlab.process(line, state, items)
+        return gitlab.process(line, line_state, items)
     elif line.startswith('reddit:'):
         import reddit
-        return reddit.process(line, state, items)
+        return reddit.process(line, line_state, items)
     elif line.startswith('include:'):
         process_file(line.split(':', 1)[1])
         return core.SUCCESS, None
     elif line.startswith(('http:', 'https:')):
         import web
-        return web.process(line, state)
+        return web.process(line, line_state)
     elif line.startswith('manual:'):
         prefix, rest = line.split(':', 1)
         timestamp, title = rest.split(' ', 1)
@@ -283,20 +123,19 @@ def handle_line(line):
         }
     elif line.startswith('custom:'):
         modulename = line.split(':', 2)[1]
-        return __import__(modulename).process(line, state)
+        return __import__(modulename).process(line, line_state)
     elif line.startswith('filter-out:'):
-        fun = eval(f'lambda e: {line[11:]}')
-        entries = [entry for entry in entries if not fun(entry)]
+        # applied by process_lines as the earlier lines are merged
         return core.SUCCESS, None
     elif line.startswith('bluesky:'):
         import bluesky
-        return bluesky.process(line, state)
+        return bluesky.process(line, line_state)
     elif line.startswith('bluesky-notifications:'):
         import bluesky
-        return bluesky.process(line, state)
+        return bluesky.process(line, line_state)
     elif line.startswith('mbox:'):
         import fm_email
-        return fm_email.process_mbox(line, state)
+        return fm_email.process_mbox(line, line_state)
     elif line.endswith('.txt'):
         process_file(line)
         return core.SUCCESS, None
@@ -316,63 +155,317 @@ def add_defaults(line, j):
             entry['fm:id'] = entry['fm:link']
         if 'fm:text' in entry and 'fm:html' not in entry:
             entry['fm:html'] = f'<div style="white-space: pre-wrap;">{html.escape(entry["fm:text"])}</div>'
+            entry['fm:html_trusted'] = True
         if 'fm:avatar' not in entry and line.startswith('https:'):
             if not favicon_checked:
-                favicon = urllib.parse.urljoin(line, '/favicon.ico')
-                try:
-                    urllib.request.urlopen(urllib.request.Request(favicon, method='HEAD'))
-                except:
-                    favicon = None
+                favicon = web.origin_favicon(line, state)
                 favicon_checked = True
             if favicon:
                 entry['fm:avatar'] = favicon
 
-        global item_counter
-        item_counter += 1
-        entry['fm:counter'] = item_counter
+def count_entry(entry):
+    global item_counter
+    item_counter += 1
+    entry['fm:counter'] = item_counter
 
 def entries_from_json(j):
     if not 'fm:entries' in j:
-        return
+        return []
     feed = j
     entry_list = j['fm:entries']
     del j['fm:entries']
     for entry in entry_list:
+        count_entry(entry)
         if j:
             entry['fm:feed'] = j
-        entries.append(entry)
+    return entry_list
 
-def process_line(line):
+def fetch_line(line):
+    # the part of processing a line that can run on a worker thread
     disposition, data = handle_line(line)
     while disposition == core.REDIRECT:
-        disposition, data = handle_line(data)
+        disposition, data = handle_line(data, line)
     if disposition == core.JSON:
         add_defaults(line, data)
-        entries_from_json(data)
     elif disposition != core.SUCCESS:
         raise Exception("unrecognized disposition")
+    return disposition, data
 
-def process_file(descfilename):
-    with open(descfilename) as f:
-        for line in f:
+class LineFilter:
+    def __init__(self, line):
+        self.line = line
+        self.fun = eval(f'lambda e: {line[11:]}')
+        self.failed = False
+
+    def __call__(self, entry):
+        try:
+            return self.fun(entry)
+        except:
+            if not self.failed:
+                print("Failed processing line: ", self.line)
+                traceback.print_exc()
+                self.failed = True
+            return False
+
+def merge_line(disposition, data, filters=()):
+    # entries are rendered right away, so only the rendered items are kept
+    if disposition == core.JSON:
+        entries = [entry for entry in entries_from_json(data) if not any(fun(entry) for fun in filters)]
+        if render_pool is not None:
+            # the spool only gets pickier as items are added, so anything it
+            # doesn't want now can be left out of rendering
+            rendered = [entry for entry in entries if archive is not None or wanted_entry(entry)]
+            for entry, item_html in zip(rendered, fm_render.render_many(render_entry, template_version, rendered, render_pool, sentinel=True)):
+                add_item(entry, item_html)
+        else:
+            for entry in entries:
+                add_item(entry)
+    items.end_run()
+
+def wanted_entry(entry):
+    try:
+        return items.wants(fm_output.timestamp_key(entry['fm:timestamp']))
+    except:
+        # add_item reports the problem
+        return True
+
+def process_line(line):
+    merge_line(*fetch_line(line))
+
+def is_file_line(line):
+    return line.startswith('include:') or (line.endswith('.txt') and ':' not in line)
+
+def reachable_lines(line, lines=None):
+    # every line process_line(line) can get to through include: and .txt lines
+    if lines is None:
+        lines = set()
+    if line in lines:
+        return lines
+    lines.add(line)
+    if is_file_line(line):
+        try:
+            with open(file_line_name(line)) as f:
+                for subline in f:
+                    reachable_lines(subline.strip(), lines)
+        except OSError:
+            pass
+    return lines
+
+def file_line_name(line):
+    return line.split(':', 1)[1] if line.startswith('include:') else line
+
+def read_lines(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f]
+
+def flatten_lines(lines):
+    # expand include: and .txt lines into the lines they contain, in order
+    result = []
+    for line in lines:
+        if is_file_line(line):
             try:
-                line = line.strip()
-                process_line(line)
+                result.extend(flatten_lines(read_lines(file_line_name(line))))
+            except:
+                print("Failed processing line: ", line)
+                traceback.print_exc()
+        else:
+            result.append(line)
+    return result
+
+def process_lines(lines):
+    # a filter-out: line drops the entries merged before it, since entries are
+    # rendered as soon as their line is merged, each filter is applied to the
+    # entries of the lines above it instead
+    filters = []
+    for position, line in enumerate(lines):
+        if line.startswith('filter-out:'):
+            try:
+                filters.append((position, LineFilter(line)))
             except:
                 print("Failed processing line: ", line)
                 traceback.print_exc()
 
-descfilename = sys.argv[1]
-output_filename = sys.argv[2]
+    # fetch concurrently, but merge in file order so the output is deterministic
+    futures = []
+    for line in lines:
+        if executor is None or line.startswith('filter-out:'):
+            futures.append(None)
+        else:
+            futures.append(executor.submit(fetch_line, line))
 
-entries = []
-items = []
+    for position, (line, future) in enumerate(zip(lines, futures)):
+        if line.startswith('filter-out:'):
+            continue
+        try:
+            if future is None:
+                disposition, data = fetch_line(line)
+            else:
+                disposition, data = future.result()
+                futures[position] = None
+            merge_line(disposition, data, [fun for filter_position, fun in filters if filter_position > position])
+        except:
+            print("Failed processing line: ", line)
+            traceback.print_exc()
 
-try:
-    with open('feed-merger-state') as f:
-        state = eval(f.read())
-except FileNotFoundError:
-    state = {}
+def process_file(filename):
+    process_lines(flatten_lines(read_lines(filename)))
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('descfilename')
+arg_parser.add_argument('output_filename')
+arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+    help="number of lines to fetch and parse concurrently")
+arg_parser.add_argument('--http-cache', default='feed-merger-http-cache',
+    help="directory for the HTTP response cache")
+arg_parser.add_argument('--http-cache-size', type=int, default=256,
+    help="maximum size of the HTTP response cache in MB, 0 to disable it")
+arg_parser.add_argument('--stale-while-revalidate', action='store_true',
+    help="use stale cached responses and revalidate them in the background")
+arg_parser.add_argument('--max-stale', type=float, default=24,
+    help="hours past going stale that --stale-while-revalidate still uses a cached response")
+arg_parser.add_argument('--state-backend', choices=('sqlite', 'file'), default='sqlite',
+    help="where to keep state between runs, feed-merger-state.db or the older feed-merger-state file")
+arg_parser.add_argument('--compact-state', action='store_true',
+    help="drop state for sources no longer reachable from the feed list")
+arg_parser.add_argument('--state-cap', type=int, default=5000,
+    help="maximum length of lists kept in state when compacting")
+arg_parser.add_argument('--state-report', action='store_true',
+    help="print the size of the state by module")
+arg_parser.add_argument('--template',
+    help="file with the template used for each entry")
+arg_parser.add_argument('--cache-dir', default='feed-merger-cache',
+    help="directory for compiled templates and rendered items")
+arg_parser.add_argument('--render-cache-size', type=int, default=64,
+    help="maximum size of the rendered item cache in MB, 0 to disable it")
+arg_parser.add_argument('--sort-memory', type=int, default=64,
+    help="MB of rendered items to keep in memory before sorting them on disk")
+arg_parser.add_argument('--newest', type=int,
+    help="only put the newest N items on the page")
+arg_parser.add_argument('--since-days', type=float,
+    help="only put items from the last N days on the page")
+arg_parser.add_argument('--per-day-pages', action='store_true',
+    help="write items left off the page to one page per day, linked from it")
+arg_parser.add_argument('--archive',
+    help="sqlite database keeping every entry and its rendered html")
+arg_parser.add_argument('--rebuild', action='store_true',
+    help="write the page from the archive without fetching anything")
+arg_parser.add_argument('--search',
+    help="write the archived entries matching an fts5 query to the page instead")
+arg_parser.add_argument('--search-limit', type=int, default=100,
+    help="maximum number of search results")
+arg_parser.add_argument('--atom',
+    help="also write the items on the page to an Atom feed")
+arg_parser.add_argument('--json-feed',
+    help="also write the items on the page to a JSON Feed")
+arg_parser.add_argument('--jsonl',
+    help="also write the items on the page to a file with one JSON object per line")
+arg_parser.add_argument('--entry-json', choices=('inline', 'sidecar', 'none'), default='inline',
+    help="where to put each entry's json: in a comment on the page, in a file next to it or nowhere")
+arg_parser.add_argument('--show-entry', type=int, metavar='COUNTER',
+    help="print the json of an entry from the page's sidecar file and exit")
+arg_parser.add_argument('--max-body-size', type=int, default=64,
+    help="MB to read of any one HTTP response before cutting it off, 0 for no limit")
+arg_parser.add_argument('--render-processes', type=int, default=0,
+    help="number of processes rendering entries, 0 to render them in this one")
+arg_parser.add_argument('--parse-processes', type=int, default=0,
+    help="number of processes parsing large feeds and pages, 0 to parse them in this one")
+arg_parser.add_argument('--tokenizer', choices=('stdlib', 'lxml'), default='stdlib',
+    help="html parser to use for pages, lxml is faster but repairs broken markup, so pages can come out differently")
+args = arg_parser.parse_args()
+
+if args.newest is not None and args.newest < 1:
+    arg_parser.error("--newest needs to be at least 1")
+if args.rebuild and not args.archive:
+    arg_parser.error("--rebuild needs --archive")
+if args.search and not args.archive:
+    arg_parser.error("--search needs --archive")
+if args.render_processes > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+    arg_parser.error("--render-processes needs a platform with fork")
+if args.parse_processes > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+    arg_parser.error("--parse-processes needs a platform with fork")
+if args.tokenizer == 'lxml' and web.lxml is None:
+    arg_parser.error("--tokenizer lxml needs lxml to be installed")
+
+descfilename = args.descfilename
+output_filename = args.output_filename
+
+if args.show_entry is not None:
+    json.dump(fm_output.read_sidecar_entry(output_filename + '.entries.jsonl', args.show_entry), sys.stdout, indent=2)
+    print()
+    sys.exit()
+
+if args.jobs > 1:
+    executor = concurrent.futures.ThreadPoolExecutor(args.jobs)
+else:
+    executor = None
+
+if args.http_cache_size > 0:
+    fm_http.open_cache(args.http_cache, args.http_cache_size * 1024 * 1024)
+fm_http.stale_while_revalidate = args.stale_while_revalidate
+fm_http.max_stale = args.max_stale * 60 * 60
+web.tokenizer_backend = args.tokenizer
+if args.max_body_size > 0:
+    fm_http.max_body_size = args.max_body_size * 1024 * 1024
+
+if args.since_days is not None:
+    since = time.time() - args.since_days * 24 * 60 * 60
+else:
+    since = None
+
+items = fm_output.ItemSpool(args.sort_memory * 1024 * 1024, args.newest, since, args.per_day_pages)
+
+if args.template:
+    with open(args.template) as f:
+        template = f.read()
+    render_entry = fm_render.load_template(template, os.path.join(args.cache_dir, 'templates'))
+else:
+    template = fm_render.entry_template
+    render_entry = fm_render.load_template(template)
+template_version = fm_render.template_version(template)
+if args.entry_json != 'inline':
+    # the same template renders differently without the entry json
+    template_version += '-no-entry-json'
+
+fm_render.inline_entry_json = args.entry_json == 'inline'
+
+if args.render_processes > 0:
+    # fork the workers now, before fetching starts any threads
+    render_pool = concurrent.futures.ProcessPoolExecutor(args.render_processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=fm_render.init_render_worker, initargs=(template, fm_render.inline_entry_json))
+    render_pool.submit(int).result()
+else:
+    render_pool = None
+
+if args.parse_processes > 0:
+    web.parse_pool = concurrent.futures.ProcessPoolExecutor(args.parse_processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=web.init_parse_worker, initargs=(web.tokenizer_backend,))
+    web.parse_pool.submit(int).result()
+
+if args.render_cache_size > 0:
+    fm_render.open_render_cache(os.path.join(args.cache_dir, 'render.sqlite'), args.render_cache_size * 1024 * 1024)
+
+if args.entry_json == 'sidecar' and output_filename != 'debug' and not args.search:
+    sidecar = fm_output.EntrySidecar(output_filename + '.entries.jsonl')
+else:
+    sidecar = None
+
+writers = []
+if output_filename != 'debug' and not args.search:
+    if args.atom:
+        writers.append(fm_output.AtomWriter(args.atom, descfilename, output_filename))
+    if args.json_feed:
+        writers.append(fm_output.JsonFeedWriter(args.json_feed, descfilename))
+    if args.jsonl:
+        writers.append(fm_output.JsonLinesWriter(args.jsonl))
+
+if args.archive and output_filename != 'debug':
+    archive = fm_archive.Archive(args.archive)
+else:
+    archive = None
+
+state = fm_state.open_state(args.state_backend)
 
 if output_filename == 'debug':
     line = descfilename
@@ -389,9 +482,9 @@ if output_filename == 'debug':
         add_defaults(line, data)
         print()
         print()
-        entries_from_json(data)
+        merge_line(disposition, data)
 
-    items_from_entries(items)
+    fm_http.finish()
 
     print("stored data:", state)
     print()
@@ -399,39 +492,69 @@ if output_filename == 'debug':
     print('items:')
     for item in items:
         print(item[1], item[0])
+elif args.search:
+    try:
+        found = list(archive.search(args.search, args.search_limit))
+    except ValueError as e:
+        archive.close()
+        arg_parser.error(str(e))
+
+    results = []
+    for source, id, timestamp, key, entry, item, version in found:
+        print(timestamp, entry.get('fm:title') or '', entry.get('fm:link') or '')
+        item = archived_html(source, id, entry, item, version)
+        if item is not None:
+            results.append((item, timestamp))
+
+    fm_output.write_page(output_filename, f'{descfilename}: {html.escape(args.search)}', results)
+
+    archive.close()
+elif args.rebuild:
+    rebuild_from_archive()
+
+    fm_output.write_pages(output_filename, descfilename, items, args.per_day_pages, writers)
+    for writer in writers:
+        writer.close()
+
+    if sidecar is not None:
+        sidecar.close()
+
+    archive.close()
 else:
     process_line(descfilename)
 
-    items_from_entries(items)
+    if executor is not None:
+        executor.shutdown()
+
+    fm_http.finish()
 
-    items.sort(key = lambda i: i[1])
+    # the archive goes first, so the state never moves past entries it lost
+    if archive is not None:
+        archive.commit()
 
-    with open(output_filename, 'w') as f:
-        f.write(
-        """<!DOCTYPE html>
-        <html lang="en">
-          <head>
-            <meta charset="utf-8">
-            <title>""")
+    fm_output.write_pages(output_filename, descfilename, items, args.per_day_pages, writers)
+    for writer in writers:
+        writer.close()
 
-        f.write(descfilename)
+    if sidecar is not None:
+        sidecar.close()
 
-        f.write("""</title>
-          <style>img { max-height: 66vh; max-width: 90vw; }</style>
-          </head>
-          <body>
-        """)
+    if args.compact_state:
+        fm_state.compact(state, reachable_lines(descfilename), args.state_cap)
 
-        for (item, timestamp) in items:
-            f.write(item)
+    if args.state_report:
+        fm_state.report(state)
 
-        f.write("</body></html>")
+    state.commit()
+    state.close()
 
-    state_str = repr(state)
-    eval(state_str)
+    if archive is not None:
+        archive.close()
 
-    with open('feed-merger-state.new', 'w') as f:
-        f.write(state_str)
 
-    os.replace('feed-merger-state.new', 'feed-merger-state')
+if render_pool is not None:
+    render_pool.shutdown()
+if web.parse_pool is not None:
+    web.parse_pool.shutdown()
 
+fm_render.close_render_cache()
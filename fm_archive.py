@@ -0,0 +1,124 @@
+import hashlib
+import html.parser
+import json
+import sqlite3
+
+def entry_id(entry):
+    # entries without an fm:id are told apart by their contents
+    if 'fm:id' in entry:
+        return str(entry['fm:id'])
+    fields = {key: value for key, value in entry.items() if key.startswith('fm:') and key not in ('fm:counter', 'fm:feed')}
+    return 'sha256:' + hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def trim_entry(entry):
+    # the feed is shared by all of its entries and mostly holds the raw
+    # response, only its fm: keys are kept for the template
+    entry = dict(entry)
+    if 'fm:feed' in entry:
+        entry['fm:feed'] = {key: value for key, value in entry['fm:feed'].items() if key.startswith('fm:')}
+    return entry
+
+class _TextExtractor(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.strs = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.strs.append(data)
+
+def html_text(data):
+    parser = _TextExtractor()
+    parser.feed(data)
+    parser.close()
+    return ' '.join(' '.join(parser.strs).split())
+
+class Archive:
+    # every entry ever merged, with its rendered html, keyed by (fm:source, fm:id)
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                source TEXT, id TEXT, timestamp TEXT, key REAL, entry TEXT, html TEXT,
+                template TEXT, added REAL, PRIMARY KEY (source, id));
+            CREATE INDEX IF NOT EXISTS entries_key ON entries (key);
+        """)
+
+        # full text search needs sqlite built with fts5
+        try:
+            exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'entries_fts'").fetchone()
+            self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(title, author, text)')
+        except sqlite3.OperationalError:
+            self.fts = False
+        else:
+            self.fts = True
+            if not exists:
+                for rowid, entry in self.db.execute('SELECT rowid, entry FROM entries').fetchall():
+                    self.index(rowid, json.loads(entry))
+                self.db.commit()
+
+    def index(self, rowid, entry):
+        self.db.execute('INSERT INTO entries_fts (rowid, title, author, text) VALUES (?, ?, ?, ?)',
+            (rowid, str(entry.get('fm:title') or ''), str(entry.get('fm:author') or ''),
+             html_text(str(entry.get('fm:html') or ''))))
+
+    def add(self, entry, item_html, key, template, added):
+        source = str(entry.get('fm:source'))
+        id = entry_id(entry)
+        if self.fts:
+            row = self.db.execute('SELECT rowid FROM entries WHERE source = ? AND id = ?', (source, id)).fetchone()
+            if row is not None:
+                self.db.execute('DELETE FROM entries_fts WHERE rowid = ?', row)
+        cursor = self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (source, id, entry['fm:timestamp'], key, json.dumps(trim_entry(entry), default=str), item_html, template, added))
+        if self.fts:
+            self.index(cursor.lastrowid, entry)
+
+    def entries(self, newest=None, since=None):
+        # (source, id, timestamp, key, entry, html, template) in timestamp order,
+        # only the newest N of them and only those from since on, if given
+        query = 'SELECT source, id, timestamp, key, entry, html, template, added FROM entries'
+        params = []
+        if since is not None:
+            query += ' WHERE key >= ?'
+            params.append(since)
+        if newest is not None:
+            query = f'SELECT * FROM ({query} ORDER BY key DESC, added DESC LIMIT ?)'
+            params.append(newest)
+        cursor = self.db.execute(query + ' ORDER BY key, added', params)
+        for source, id, timestamp, key, entry, item_html, template, added in cursor:
+            yield source, id, timestamp, key, json.loads(entry), item_html, template
+
+    def search(self, query, limit=100):
+        # like entries(), best matches first, query uses the fts5 syntax
+        if not self.fts:
+            raise Exception("full text search needs sqlite with fts5")
+        try:
+            cursor = self.db.execute("""
+                SELECT source, id, timestamp, key, entry, html, template FROM entries_fts
+                JOIN entries ON entries.rowid = entries_fts.rowid
+                WHERE entries_fts MATCH ? ORDER BY rank LIMIT ?""", (query, limit))
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"bad search query {query!r}: {e}")
+        for source, id, timestamp, key, entry, item_html, template in cursor:
+            yield source, id, timestamp, key, json.loads(entry), item_html, template
+
+    def update_html(self, source, id, item_html, template):
+        self.db.execute('UPDATE entries SET html = ?, template = ? WHERE source = ? AND id = ?',
+            (item_html, template, source, id))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
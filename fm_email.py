@@ -11,6 +11,7 @@ import urllib.request
 import publicsuffixlist
 
 import core
+import fm_http
 import web
 
 psl = publicsuffixlist.PublicSuffixList()
@@ -54,22 +55,16 @@ def extract_nextdoor_avatar(html_data):
     parser.feed(html_data)
     tokens = parser.tokens
 
-    for token in tokens:
-        if token[0] == web.STARTTAG and token[1] == 'img':
-            attrs = dict(token[2])
-            if attrs.get('alt', '').endswith('s profile photo') and attrs.get('src', '').endswith('.crop20x20.jpg'):
-                return attrs['src'].replace('.crop20x20.jpg', '.crop96x96.jpg')
+    for i in tokens.select('img[alt$="s profile photo"][src$=".crop20x20.jpg"]'):
+        return tokens.attrs(i)['src'].replace('.crop20x20.jpg', '.crop96x96.jpg')
 
 def extract_patreon_avatar(html_data):
     parser = web.HtmlTokenizer()
     parser.feed(html_data)
     tokens = parser.tokens
 
-    for token in tokens:
-        if token[0] == web.STARTTAG and token[1] == 'img':
-            attrs = dict(token[2])
-            if '/patreon-media/p/campaign/' in attrs.get('src', ''):
-                return attrs['src']
+    for i in tokens.select('img[src*="/patreon-media/p/campaign/"]'):
+        return tokens.attrs(i)['src']
 
 def extract_bandcamp_info(html_data):
     result = {}
@@ -78,21 +73,17 @@ def extract_bandcamp_info(html_data):
     parser.feed(html_data)
     tokens = parser.tokens
 
-    for i in range(len(tokens)-1):
-        token = tokens[i]
-        if token[0] == web.STARTTAG and token[1] == 'a' and tokens[i+1][0] == web.DATA and tokens[i+1][1] == 'check it out here':
-            attrs = dict(token[2])
-            if attrs.get('href'):
-                result['fm:link'] = attrs['href']
+    for i in tokens.select('a[href]'):
+        if i + 1 < len(tokens) and tokens[i+1][0] == web.DATA and tokens[i+1][1] == 'check it out here':
+            if tokens.attrs(i)['href']:
+                result['fm:link'] = tokens.attrs(i)['href']
 
     if 'fm:link' in result:
         try:
             tokens = web.get_page_tokens(result['fm:link'])
-            for token in tokens:
-                if token[0] == web.STARTTAG and token[1] == 'img':
-                    attrs = dict(token[2])
-                    if attrs.get('class') == 'band-photo' and attrs.get('src'):
-                        result['fm:avatar'] = attrs['src']
+            for i in tokens.select('img[class=band-photo][src]'):
+                if tokens.attrs(i)['src']:
+                    result['fm:avatar'] = tokens.attrs(i)['src']
         except:
             pass
 
@@ -101,68 +92,70 @@ def extract_bandcamp_info(html_data):
 bimi_cache = {}
 
 def avatar_from_bimi_domain(suffix, selector="default"):
-    if (suffix, selector) in bimi_cache:
-        return bimi_cache[suffix, selector]
-
-    result = None
-
-    try:
-        bimi_answer = dns.resolver.query(f'{selector}._bimi.{suffix}', 'TXT')
-
-        for rdata in bimi_answer:
-            txt_string = b''.join(rdata.strings).decode('utf8')
-            terms = txt_string.split('; ')
-            if 'v=BIMI1' in terms:
-                for term in terms:
-                    if term.startswith('l='):
-                        result = term[2:]
-                        break
-    except dns.resolver.NoAnswer:
-        pass
-    except dns.resolver.NXDOMAIN:
-        pass
-
-    bimi_cache[suffix, selector] = result
-    return result
+    with core.lock('bimi', suffix, selector):
+        if (suffix, selector) in bimi_cache:
+            return bimi_cache[suffix, selector]
+
+        result = None
+
+        try:
+            bimi_answer = dns.resolver.query(f'{selector}._bimi.{suffix}', 'TXT')
+
+            for rdata in bimi_answer:
+                txt_string = b''.join(rdata.strings).decode('utf8')
+                terms = txt_string.split('; ')
+                if 'v=BIMI1' in terms:
+                    for term in terms:
+                        if term.startswith('l='):
+                            result = term[2:]
+                            break
+        except dns.resolver.NoAnswer:
+            pass
+        except dns.resolver.NXDOMAIN:
+            pass
+
+        bimi_cache[suffix, selector] = result
+        return result
 
 avatar_cache = {}
 
-def get_avatar(from_addr, selector="default"):
-    from_host = from_addr.rsplit('@', 1)[1]
+def get_avatar(from_addr, selector="default", state=None):
+    with core.lock('avatar', from_addr, selector):
+        from_host = from_addr.rsplit('@', 1)[1]
 
-    if (from_addr, selector) in avatar_cache:
-        return avatar_cache[from_addr, selector]
+        if (from_addr, selector) in avatar_cache:
+            return avatar_cache[from_addr, selector]
 
-    avatar = avatar_from_bimi_domain(from_host, selector)
+        avatar = avatar_from_bimi_domain(from_host, selector)
 
-    if not avatar:
-        org_domain = psl.privatesuffix(from_host)
+        if not avatar:
+            org_domain = psl.privatesuffix(from_host)
 
-        if org_domain != from_host:
-            avatar = avatar_from_bimi_domain(org_domain, selector)
+            if org_domain != from_host:
+                avatar = avatar_from_bimi_domain(org_domain, selector)
 
-    if not avatar:
-        gravatar_url = gravatar_for_email(from_addr, '404')
-        try:
-            req = urllib.request.Request(gravatar_url, method='HEAD')
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError:
-            pass
-        else:
-            avatar = gravatar_url
+        if not avatar:
+            gravatar_url = gravatar_for_email(from_addr, '404')
+            try:
+                req = urllib.request.Request(gravatar_url, method='HEAD')
+                fm_http.urlopen(req)
+            except urllib.error.HTTPError:
+                pass
+            else:
+                avatar = gravatar_url
 
-    if not avatar:
-        avatar = web.find_favicon(f'https://{from_host}/')
+        if not avatar:
+            avatar = web.find_favicon(f'https://{from_host}/', state)
 
-    if not avatar:
-        avatar = web.find_favicon(f'https://www.{from_host}/')
+        if not avatar:
+            avatar = web.find_favicon(f'https://www.{from_host}/', state)
 
-    if not avatar:
-        avatar = gravatar_for_email(from_addr, 'monsterid')
+        if not avatar:
+            avatar = gravatar_for_email(from_addr, 'monsterid')
 
-    avatar_cache[from_addr, selector] = avatar
+        avatar_cache[from_addr, selector] = avatar
 
-    return avatar
+        return avatar
 
 def gravatar_for_email(addr, default):
     email_encoded = addr.lower().encode('utf-8')
@@ -170,7 +163,7 @@ def gravatar_for_email(addr, default):
     query_params = urllib.parse.urlencode({'d': default})
     return f"https://www.gravatar.com/avatar/{email_hash}?{query_params}"
 
-def format_message(msg, format_html=False):
+def format_message(msg, format_html=False, state=None):
     result = {}
 
     result['email:headers'] = headers = {}
@@ -201,21 +194,17 @@ def format_message(msg, format_html=False):
 
     if format_html:
         result['fm:html'] = format_content(msg)
+        # only text/html parts are markup from the sender
+        if not any(part.get_content_type() == 'text/html' for part in msg.walk()):
+            result['fm:html_trusted'] = True
 
         parser = web.HtmlTokenizer()
         parser.feed(result['fm:html'])
         tokens = parser.tokens
 
-        in_inboxmarkup = False
-        for token in tokens:
-            if token[0] == web.STARTTAG and token[1] == 'script':
-                attrs = dict(token[2])
-                if attrs.get('data-scope') == 'inboxmarkup' and attrs.get('type') == 'application/json':
-                    in_inboxmarkup = True
-            elif in_inboxmarkup:
-                if token[0] == web.ENDTAG:
-                    in_inboxmarkup = False
-                elif token[0] == web.DATA:
+        for i in tokens.select('script[data-scope=inboxmarkup][type="application/json"]'):
+            for token in tokens[i+1:tokens.end_of(i)]:
+                if token[0] == web.DATA:
                     result['email:inboxmarkup'] = json.loads(html.unescape(token[1]))
 
     if result.get('email:inboxmarkup'):
@@ -248,16 +237,16 @@ def format_message(msg, format_html=False):
             else:
                 selector = 'default'
 
-            avatar = get_avatar(from_addr, selector)
+            avatar = get_avatar(from_addr, selector, state)
 
         result['fm:avatar'] = avatar
 
     return result
 
-def format_email(raw_mail):
+def format_email(raw_mail, state=None):
     msg = email.message_from_bytes(raw_mail, policy=email.policy.default)
 
-    return format_message(msg, True)
+    return format_message(msg, True, state)
 
 def process_mbox(line, state):
     import mailbox
@@ -289,7 +278,7 @@ def process_mbox(line, state):
                 new_last_ofs = f.tell() - len(line)
 
                 if use:
-                    entries.append(format_email(b''.join(data)))
+                    entries.append(format_email(b''.join(data), state))
                     data = []
 
                 sortdate = email.utils.parsedate_to_datetime(
@@ -307,7 +296,7 @@ def process_mbox(line, state):
                 data.append(line)
 
     if use:
-        entries.append(format_email(b''.join(data)))
+        entries.append(format_email(b''.join(data), state))
 
     if new_last_seen:
         state[('mbox', filename, 'last_seen')] = new_last_seen
@@ -0,0 +1,670 @@
+import asyncio
+import email.utils
+import hashlib
+import http.client
+import io
+import json
+import os
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# HTTP/1.1 client on an asyncio event loop. The loop runs on its own thread,
+# so synchronous code can use urlopen() while async callers can have many
+# requests in flight at once. Connections are kept alive and reused per host.
+
+_USER_AGENT = f'Python-urllib/{urllib.request.__version__}'
+
+MAX_REDIRECTS = 10
+
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30 # seconds an unused connection is kept open
+DNS_TTL = 300
+
+# everything below is only touched from the loop thread
+_idle_connections = {} # (scheme, host, port): [Connection]
+_host_slots = {} # (scheme, host, port): asyncio.Semaphore
+_dns_cache = {} # (host, port): (addrinfo list, expiry time)
+_revalidations = set()
+
+# responses longer than this many bytes are cut off, None for no limit
+max_body_size = None
+
+# on-disk response cache, see open_cache()
+cache = None
+# serve stale cached responses right away and revalidate them in the background
+stale_while_revalidate = False
+# but not ones that went stale more than this many seconds ago
+max_stale = 24 * 60 * 60
+
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+_ssl_context = None
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='fm_http', daemon=True).start()
+        return _loop
+
+def run(coro):
+    # run a coroutine on the network thread and wait for its result
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+async def gather(coros, return_exceptions=False):
+    return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+def get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+        _ssl_context.set_alpn_protocols(['http/1.1'])
+    return _ssl_context
+
+class Response:
+    # quacks enough like http.client.HTTPResponse for our callers
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = self.code = status
+        self.reason = self.msg = reason
+        self.headers = headers
+        self.fp = io.BytesIO(body)
+        self.truncated = False
+
+    def read(self, amt=None):
+        return self.fp.read(amt)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _request_headers(request):
+    # case-insensitive merge of our defaults and the request's headers
+    headers = {}
+    def add(key, value):
+        headers[key.lower()] = (key, value)
+
+    add('Host', request.host)
+    add('User-Agent', _USER_AGENT)
+    add('Accept-Encoding', 'identity')
+    add('Connection', 'keep-alive')
+    if request.data is not None:
+        add('Content-Type', 'application/x-www-form-urlencoded')
+        add('Content-Length', str(len(request.data)))
+    for key, value in request.header_items():
+        add(key, value)
+
+    return list(headers.values())
+
+def _truncated(url, limit):
+    print(f"Response from {url} is larger than {limit} bytes, truncated")
+
+async def _read_body(reader, method, status, headers, url):
+    # returns body, whether the connection can be reused afterwards, and
+    # whether the body was cut off at max_body_size
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        return b'', True, False
+
+    limit = max_body_size
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            if limit is not None and total + size > limit:
+                chunks.append(await reader.readexactly(limit - total))
+                _truncated(url, limit)
+                return b''.join(chunks), False, True
+            chunks.append(await reader.readexactly(size))
+            total += size
+            await reader.readline()
+        # trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks), True, False
+
+    if headers.get('content-length'):
+        length = int(headers['content-length'])
+        if limit is not None and length > limit:
+            body = await reader.readexactly(limit)
+            _truncated(url, limit)
+            return body, False, True
+        return await reader.readexactly(length), True, False
+
+    if limit is None:
+        return await reader.read(), False, False
+
+    chunks = []
+    total = 0
+    while total < limit:
+        chunk = await reader.read(min(65536, limit - total))
+        if not chunk:
+            return b''.join(chunks), False, False
+        chunks.append(chunk)
+        total += len(chunk)
+    truncated = bool(await reader.read(1))
+    if truncated:
+        _truncated(url, limit)
+    return b''.join(chunks), False, truncated
+
+async def _resolve(host, port):
+    now = time.monotonic()
+    cached = _dns_cache.get((host, port))
+    if cached and cached[1] > now:
+        return cached[0]
+
+    infos = await get_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    _dns_cache[host, port] = infos, now + DNS_TTL
+    return infos
+
+class Connection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = None
+        self.answered = False # whether a status line came back for the last request
+
+    def close(self):
+        self.writer.close()
+
+async def _connect(key):
+    scheme, host, port = key
+
+    if scheme == 'https':
+        ssl_args = {'ssl': get_ssl_context(), 'server_hostname': host}
+    elif scheme == 'http':
+        ssl_args = {}
+    else:
+        raise urllib.error.URLError(f'unknown url type: {scheme}')
+
+    error = None
+    for family, type, proto, canonname, sockaddr in await _resolve(host, port):
+        try:
+            reader, writer = await asyncio.open_connection(sockaddr[0], port, family=family, **ssl_args)
+        except OSError as e:
+            error = e
+            continue
+        return Connection(key, reader, writer)
+
+    raise error or OSError(f'could not connect to {host}')
+
+def _get_idle_connection(key):
+    idle = _idle_connections.get(key)
+    now = time.monotonic()
+    while idle:
+        connection = idle.pop()
+        if connection.reader.at_eof() or now - connection.idle_since > IDLE_TIMEOUT:
+            connection.close()
+            continue
+        return connection
+
+def _release_connection(connection):
+    connection.idle_since = time.monotonic()
+    _idle_connections.setdefault(connection.key, []).append(connection)
+
+async def _exchange(connection, request):
+    reader = connection.reader
+    writer = connection.writer
+
+    method = request.get_method()
+    connection.answered = False
+    lines = [f'{method} {request.selector} HTTP/1.1']
+    for key, value in _request_headers(request):
+        lines.append(f'{key}: {value}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+    if request.data is not None:
+        writer.write(request.data)
+    await writer.drain()
+
+    while True:
+        status_line = (await reader.readline()).decode('iso-8859-1')
+        if not status_line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        connection.answered = True
+        try:
+            version, status, reason = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+        if status != 100:
+            break
+
+    body, reusable, truncated = await _read_body(reader, method, status, headers, request.full_url)
+
+    connection_header = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        reusable = reusable and 'keep-alive' in connection_header
+    else:
+        reusable = reusable and 'close' not in connection_header
+
+    response = Response(request.full_url, status, reason.strip(), headers, body)
+    response.truncated = truncated
+    return response, reusable
+
+async def _send(request):
+    parsed = urllib.parse.urlsplit(request.full_url)
+    key = (request.type, parsed.hostname, parsed.port or (443 if request.type == 'https' else 80))
+
+    if key not in _host_slots:
+        _host_slots[key] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+
+    async with _host_slots[key]:
+        connection = _get_idle_connection(key)
+        if connection is not None:
+            try:
+                response, reusable = await _exchange(connection, request)
+            except BaseException as e:
+                connection.close()
+                # the server probably closed the idle connection, which is only
+                # safe to try again on a new one if it never started answering
+                # and the request can be repeated
+                if connection.answered or request.get_method() not in ('GET', 'HEAD') or not isinstance(e, OSError):
+                    raise
+                connection = None
+
+        if connection is None:
+            connection = await _connect(key)
+            try:
+                response, reusable = await _exchange(connection, request)
+            except:
+                connection.close()
+                raise
+
+        if reusable:
+            _release_connection(connection)
+        else:
+            connection.close()
+
+    return response
+
+def _cache_control(headers):
+    directives = {}
+    for value in headers.get_all('cache-control') or ():
+        for directive in value.split(','):
+            name, _, arg = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = arg.strip('"')
+    return directives
+
+def _parse_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
+def _weak_etag(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag
+
+def _copy_headers(headers):
+    result = http.client.HTTPMessage()
+    for key, value in headers.items():
+        result[key] = value
+    return result
+
+class CacheEntry:
+    def __init__(self, key, url, status, reason, headers, body_path, stored):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body_path = body_path
+        self.stored = stored
+
+    def age(self):
+        return time.time() - self.stored + _seconds(self.headers.get('age', '0'))
+
+    def lifetime(self):
+        # no heuristic freshness: without explicit freshness we revalidate
+        cc = _cache_control(self.headers)
+        if 'no-cache' in cc:
+            return 0
+        if 'max-age' in cc:
+            return _seconds(cc['max-age'])
+        if self.headers.get('expires') is not None:
+            expires = _parse_date(self.headers['expires'])
+            date = _parse_date(self.headers.get('date'))
+            if expires is None or date is None:
+                return 0
+            return max(0, expires - date)
+        return 0
+
+    def fresh(self):
+        return self.age() < self.lifetime()
+
+    def usable_stale(self):
+        if stale_while_revalidate:
+            return self.age() < self.lifetime() + max_stale
+        cc = _cache_control(self.headers)
+        if 'stale-while-revalidate' in cc and 'must-revalidate' not in cc:
+            return self.age() < self.lifetime() + _seconds(cc['stale-while-revalidate'])
+        return False
+
+    def answer(self, request_headers, method):
+        # apply the caller's own conditional headers to the cached response
+        etag = self.headers.get('etag')
+        last_modified = _parse_date(self.headers.get('last-modified'))
+        if 'if-none-match' in request_headers:
+            tags = [_weak_etag(tag) for tag in request_headers['if-none-match'].split(',')]
+            not_modified = '*' in tags or (etag is not None and _weak_etag(etag) in tags)
+        elif 'if-modified-since' in request_headers:
+            since = _parse_date(request_headers['if-modified-since'])
+            not_modified = last_modified is not None and since is not None and last_modified <= since
+        else:
+            not_modified = False
+
+        if not_modified:
+            return Response(self.url, 304, 'Not Modified', _copy_headers(self.headers), b'')
+
+        if method == 'HEAD':
+            body = b''
+        else:
+            with open(self.body_path, 'rb') as f:
+                body = f.read()
+        return Response(self.url, self.status, self.reason, _copy_headers(self.headers), body)
+
+class Cache:
+    # response metadata lives in an sqlite index, bodies are stored once per
+    # distinct content under objects/, and the least recently used responses
+    # are dropped when the bodies take more than max_size bytes. the methods
+    # do blocking io, so the network thread calls them with asyncio.to_thread
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, url TEXT, status INTEGER, reason TEXT,
+                headers TEXT, vary TEXT, body TEXT, stored REAL, used REAL);
+            CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+            CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, size INTEGER);
+        """)
+        self.total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM bodies').fetchone()[0]
+
+    def body_path(self, body_hash):
+        return os.path.join(self.path, 'objects', body_hash[:2], body_hash[2:])
+
+    def lookup(self, key, request_headers):
+        with self.lock:
+            return self._lookup(key, request_headers)
+
+    def _lookup(self, key, request_headers):
+        row = self.db.execute('SELECT url, status, reason, headers, vary, body, stored FROM responses WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+
+        url, status, reason, headers, vary, body_hash, stored = row
+
+        for name, value in json.loads(vary).items():
+            if request_headers.get(name) != value:
+                return None
+
+        if not os.path.exists(self.body_path(body_hash)):
+            self._remove(key)
+            return None
+
+        self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+
+        message = http.client.HTTPMessage()
+        for name, value in json.loads(headers):
+            message[name] = value
+
+        return CacheEntry(key, url, status, reason, message, self.body_path(body_hash), stored)
+
+    def store(self, key, request_headers, response):
+        headers = response.headers
+
+        if response.status not in CACHEABLE_STATUSES or 'no-store' in _cache_control(headers) or response.truncated:
+            return
+
+        # anything else would have to be fetched again anyway
+        if not headers.get('etag') and not headers.get('last-modified') and \
+            not CacheEntry(key, None, None, None, headers, None, time.time()).lifetime():
+            return
+
+        vary = {}
+        for value in headers.get_all('vary') or ():
+            for name in value.split(','):
+                name = name.strip().lower()
+                if name == '*':
+                    return
+                if name:
+                    vary[name] = request_headers.get(name)
+
+        body = response.fp.getvalue()
+        body_hash = hashlib.sha256(body).hexdigest()
+        path = self.body_path(body_hash)
+
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.new', 'wb') as f:
+                    f.write(body)
+                os.replace(path + '.new', path)
+
+            self._remove(key)
+
+            now = time.time()
+            if self.db.execute('INSERT OR IGNORE INTO bodies VALUES (?, ?)', (body_hash, len(body))).rowcount:
+                self.total += len(body)
+            self.db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, response.status, response.reason, json.dumps(list(headers.items())),
+                 json.dumps(vary), body_hash, now, now))
+
+            self._evict()
+            self.db.commit()
+
+    def refresh(self, entry, headers):
+        # merge the headers of a 304 response into the stored response
+        merged = _copy_headers(entry.headers)
+        for name in set(headers.keys()):
+            if name.lower() in ('content-length', 'transfer-encoding', 'content-encoding'):
+                continue
+            del merged[name]
+            for value in headers.get_all(name):
+                merged[name] = value
+
+        entry.headers = merged
+        entry.stored = time.time()
+        with self.lock:
+            self.db.execute('UPDATE responses SET headers = ?, stored = ?, used = ? WHERE key = ?',
+                (json.dumps(list(merged.items())), entry.stored, entry.stored, entry.key))
+            self.db.commit()
+
+    def _remove(self, key):
+        row = self.db.execute('SELECT body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+        if self.db.execute('SELECT 1 FROM responses WHERE body = ?', row).fetchone() is None:
+            size = self.db.execute('SELECT size FROM bodies WHERE hash = ?', row).fetchone()
+            if size is not None:
+                self.total -= size[0]
+            self.db.execute('DELETE FROM bodies WHERE hash = ?', row)
+            try:
+                os.unlink(self.body_path(row[0]))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        if self.total <= self.max_size:
+            return
+
+        for (key,) in self.db.execute('SELECT key FROM responses ORDER BY used').fetchall():
+            self._remove(key)
+            if self.total <= self.max_size:
+                break
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+def open_cache(path, max_size):
+    global cache
+    cache = Cache(path, max_size)
+
+async def _send_timeout(request, timeout):
+    try:
+        if timeout is None:
+            return await _send(request)
+        else:
+            return await asyncio.wait_for(_send(request), timeout)
+    except (OSError, EOFError, asyncio.TimeoutError, http.client.HTTPException) as e:
+        raise urllib.error.URLError(e)
+
+async def _revalidate(request, entry, timeout):
+    # returns the refreshed entry, or the new response if it changed
+    conditional = urllib.request.Request(request.full_url, headers=dict(request.header_items()),
+        method=request.get_method())
+    # the caller's own conditions are checked against the cache afterwards
+    conditional.remove_header('If-none-match')
+    conditional.remove_header('If-modified-since')
+    if entry.headers.get('etag'):
+        conditional.add_header('If-None-Match', entry.headers['etag'])
+    if entry.headers.get('last-modified'):
+        conditional.add_header('If-Modified-Since', entry.headers['last-modified'])
+
+    response = await _send_timeout(conditional, timeout)
+    if response.status == 304:
+        await asyncio.to_thread(cache.refresh, entry, response.headers)
+        return entry
+    return response
+
+async def _revalidate_in_background(request, key, request_headers, entry, timeout):
+    try:
+        result = await _revalidate(request, entry, timeout)
+        if result is not entry:
+            await asyncio.to_thread(cache.store, key, request_headers, result)
+    except Exception as e:
+        print(f"Failed revalidating {request.full_url}: {e}")
+
+async def _send_cached(request, timeout):
+    request_headers = {key.lower(): value for key, value in request.header_items()}
+    method = request.get_method()
+
+    if cache is None or method not in ('GET', 'HEAD') or request.data is not None or \
+        'authorization' in request_headers or 'cookie' in request_headers:
+        return await _send_timeout(request, timeout)
+
+    key = f'{method} {request.full_url}'
+    entry = await asyncio.to_thread(cache.lookup, key, request_headers)
+
+    if entry is None:
+        response = await _send_timeout(request, timeout)
+    elif entry.fresh():
+        response = None
+    elif entry.usable_stale():
+        task = get_loop().create_task(_revalidate_in_background(request, key, request_headers, entry, timeout))
+        _revalidations.add(task)
+        task.add_done_callback(_revalidations.discard)
+        response = None
+    else:
+        response = await _revalidate(request, entry, timeout)
+        if response is entry:
+            response = None
+
+    if response is not None:
+        await asyncio.to_thread(cache.store, key, request_headers, response)
+        return response
+
+    return await asyncio.to_thread(entry.answer, request_headers, method)
+
+async def fetch(request, timeout=None):
+    if isinstance(request, str):
+        request = urllib.request.Request(request)
+
+    redirect_handler = urllib.request.HTTPRedirectHandler()
+
+    for redirects in range(MAX_REDIRECTS + 1):
+        response = await _send_cached(request, timeout)
+
+        if 200 <= response.status < 300:
+            return response
+
+        location = response.headers.get('location') or response.headers.get('uri')
+        if response.status in (301, 302, 303, 307, 308) and location and redirects < MAX_REDIRECTS:
+            new_url = urllib.parse.urljoin(request.full_url, location)
+            new_request = redirect_handler.redirect_request(request, response.fp,
+                response.status, response.reason, response.headers, new_url)
+            if new_request is not None:
+                request = new_request
+                continue
+
+        raise urllib.error.HTTPError(response.url, response.status, response.reason, response.headers, response.fp)
+
+def urlopen(url, data=None, timeout=None):
+    # drop-in replacement for urllib.request.urlopen
+    if isinstance(url, str):
+        request = urllib.request.Request(url, data=data)
+    else:
+        request = url
+        if data is not None:
+            request.data = data
+    return run(fetch(request, timeout))
+
+async def _wait_for_revalidations():
+    while _revalidations:
+        await asyncio.gather(*_revalidations, return_exceptions=True)
+
+def finish():
+    # wait for background revalidations and save the cache
+    if _loop is not None:
+        run(_wait_for_revalidations())
+    if cache is not None:
+        cache.close()
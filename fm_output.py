@@ -0,0 +1,326 @@
+import datetime
+import email.utils
+import hashlib
+import heapq
+import html
+import json
+import os
+import re
+import tempfile
+import time
+import urllib.parse
+
+import fm_archive
+import fm_render
+
+def timestamp_key(timestamp):
+    # seconds since the epoch, so timestamps with different offsets sort
+    # correctly, naive ones are taken as UTC and unparseable ones as now
+    try:
+        dt = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        try:
+            dt = email.utils.parsedate_to_datetime(timestamp)
+        except (TypeError, ValueError, IndexError):
+            return time.time()
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+def _read_run(f):
+    f.seek(0)
+    for line in f:
+        yield tuple(json.loads(line))
+
+class ItemSpool:
+    # rendered items are collected into runs, one per source, each run is
+    # sorted when it ends and the runs are merged when the page is written,
+    # once the runs held in memory pass max_memory bytes they are merged into
+    # a temporary file
+    #
+    # newest and since limit which items go on the main page, unless
+    # keep_older is set items that can't make it there are never rendered
+    def __init__(self, max_memory=64 * 1024 * 1024, newest=None, since=None, keep_older=False):
+        self.max_memory = max_memory
+        self.current = []
+        self.runs = [] # sorted lists of (key, seq, timestamp, html, record)
+        self.memory = 0
+        self.files = []
+        self.seq = 0
+        self.newest = newest
+        self.since = since
+        self.keep_older = keep_older
+        self.heap = [] # the newest (key, seq) pairs so far, up to newest of them
+
+    def wants(self, key):
+        if self.keep_older:
+            return True
+        if self.since is not None and key < self.since:
+            return False
+        if self.newest is not None and len(self.heap) >= self.newest and (not self.heap or key < self.heap[0][0]):
+            return False
+        return True
+
+    def append(self, item, key=None, record=None):
+        # record is the entry_record() for the machine readable outputs
+        item_html, timestamp = item
+        if key is None:
+            key = timestamp_key(timestamp)
+        self.current.append((key, self.seq, timestamp, item_html, record))
+        if self.newest is not None and (self.since is None or key >= self.since):
+            if len(self.heap) < self.newest:
+                heapq.heappush(self.heap, (key, self.seq))
+            elif self.newest:
+                heapq.heappushpop(self.heap, (key, self.seq))
+        self.seq += 1
+        self.memory += len(item_html)
+
+    def on_main_page(self, key, seq):
+        if self.since is not None and key < self.since:
+            return False
+        if self.newest is not None and (not self.heap or (key, seq) < self.heap[0]):
+            return False
+        return True
+
+    def end_run(self):
+        if self.current:
+            self.current.sort()
+            self.runs.append(self.current)
+            self.current = []
+        if self.memory > self.max_memory:
+            self.spill()
+
+    def spill(self):
+        f = tempfile.TemporaryFile('w+', encoding='utf-8')
+        for item in heapq.merge(*self.runs):
+            f.write(json.dumps(item, default=str))
+            f.write('\n')
+        self.files.append(f)
+        self.runs = []
+        self.memory = 0
+
+    def __len__(self):
+        return self.seq
+
+    def sorted_items(self):
+        # (key, seq, timestamp, html, record) in timestamp order
+        self.end_run()
+        return heapq.merge(*self.runs, *(_read_run(f) for f in self.files))
+
+    def __iter__(self):
+        for key, seq, timestamp, item_html, record in self.sorted_items():
+            yield item_html, timestamp
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+def write_header(f, title):
+    f.write(
+        """<!DOCTYPE html>
+        <html lang="en">
+          <head>
+            <meta charset="utf-8">
+            <title>""")
+
+    f.write(title)
+
+    f.write("""</title>
+          <style>img { max-height: 66vh; max-width: 90vw; }</style>
+          </head>
+          <body>
+        """)
+
+def write_footer(f):
+    f.write("</body></html>")
+
+def write_page(filename, title, items):
+    with open(filename, 'w') as f:
+        write_header(f, title)
+
+        for (item, timestamp) in items:
+            f.write(item)
+
+        write_footer(f)
+
+def write_pages(filename, title, spool, per_day=False, writers=()):
+    # items that don't make the main page go to one page per day (UTC) next to
+    # it, named like out-2024-01-31.html and linked from the bottom of it,
+    # the items on the main page also go to each of writers
+    root, ext = os.path.splitext(filename)
+    days = []
+    day_file = None
+
+    with open(filename, 'w') as f:
+        write_header(f, title)
+
+        for key, seq, timestamp, item, record in spool.sorted_items():
+            if spool.on_main_page(key, seq):
+                f.write(item)
+                for writer in writers:
+                    writer.write(record, key)
+            elif per_day:
+                day = datetime.datetime.fromtimestamp(key, datetime.timezone.utc).date().isoformat()
+                if not days or days[-1] != day:
+                    if day_file is not None:
+                        write_footer(day_file)
+                        day_file.close()
+                    day_file = open(f'{root}-{day}{ext}', 'w')
+                    write_header(day_file, f'{title} {day}')
+                    days.append(day)
+                day_file.write(item)
+
+        if day_file is not None:
+            write_footer(day_file)
+            day_file.close()
+
+        if days:
+            f.write('<p>Older items:')
+            for day in reversed(days):
+                link = html.escape(urllib.parse.quote(os.path.basename(f'{root}-{day}{ext}')))
+                f.write(f' <a href="{link}">{day}</a>')
+            f.write('</p>')
+
+        write_footer(f)
+
+class EntrySidecar:
+    # the json of each entry, one per line, with an index from fm:counter to
+    # where it is in the file kept next to it
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.index = {}
+
+    def write(self, entry):
+        data = json.dumps(entry, default=str, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.index[entry['fm:counter']] = (self.file.tell(), len(data))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        with open(self.filename + '.idx', 'w') as f:
+            json.dump(self.index, f)
+
+def read_sidecar_entry(filename, counter):
+    with open(filename + '.idx') as f:
+        offset, length = json.load(f)[str(counter)]
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+def entry_record(entry):
+    # the fields of an entry the machine readable outputs use
+    feed = entry.get('fm:feed', {})
+    record = {
+        'id': fm_archive.entry_id(entry),
+        'source': entry.get('fm:source'),
+        'timestamp': entry.get('fm:timestamp'),
+        'title': entry.get('fm:title'),
+        'link': entry.get('fm:link'),
+        'author': entry.get('fm:author'),
+        'author_link': entry.get('fm:author_link'),
+        'avatar': entry.get('fm:avatar'),
+        'thumbnail': entry.get('fm:thumbnail'),
+        'feed_title': entry.get('fm:feedname') or feed.get('fm:title'),
+        # the html as it is on the page, with its urls made absolute, the page
+        # just translated it so this comes from the render cache
+        'html': fm_render.translate_html(feed, entry, entry['fm:html']) if entry.get('fm:html') else None,
+    }
+    return {key: value for key, value in record.items() if value is not None}
+
+def _iso_time(key):
+    return datetime.datetime.fromtimestamp(key, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def _record_uri(record):
+    if urllib.parse.urlsplit(record['id']).scheme:
+        return record['id']
+    digest = hashlib.sha256(f"{record.get('source')} {record['id']}".encode('utf-8')).hexdigest()
+    return f'urn:sha256:{digest}'
+
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def _xml(value):
+    return html.escape(_XML_INVALID.sub('', str(value)))
+
+class AtomWriter:
+    # page is the html page written along with the feed, linked relative to it
+    def __init__(self, filename, title, page=None):
+        self.file = open(filename, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.file.write('<feed xmlns="http://www.w3.org/2005/Atom">\n')
+        self.file.write(f'<title>{_xml(title)}</title>\n')
+        self.file.write(f'<author><name>{_xml(title)}</name></author>\n')
+        self.file.write(f'<link rel="self" href="{_xml(urllib.parse.quote(os.path.basename(filename)))}"/>\n')
+        if page is not None:
+            href = os.path.relpath(page, os.path.dirname(os.path.abspath(filename)))
+            self.file.write(f'<link rel="alternate" type="text/html" href="{_xml(urllib.parse.quote(href))}"/>\n')
+        self.file.write(f'<id>urn:sha256:{hashlib.sha256(title.encode("utf-8")).hexdigest()}</id>\n')
+        self.file.write(f'<updated>{_iso_time(time.time())}</updated>\n')
+
+    def write(self, record, key):
+        strs = ['<entry>']
+        strs.append(f'<id>{_xml(_record_uri(record))}</id>')
+        strs.append(f'<title>{_xml(record.get("title") or record.get("feed_title") or "")}</title>')
+        strs.append(f'<updated>{_iso_time(key)}</updated>')
+        if record.get('link'):
+            strs.append(f'<link href="{_xml(record["link"])}"/>')
+        if record.get('author'):
+            strs.append(f'<author><name>{_xml(record["author"])}</name>')
+            if record.get('author_link'):
+                strs.append(f'<uri>{_xml(record["author_link"])}</uri>')
+            strs.append('</author>')
+        if record.get('html'):
+            strs.append('<content type="html">')
+            strs.append(_xml(record['html']))
+            strs.append('</content>')
+        strs.append('</entry>\n')
+        self.file.write(''.join(strs))
+
+    def close(self):
+        self.file.write('</feed>\n')
+        self.file.close()
+
+class JsonFeedWriter:
+    def __init__(self, filename, title):
+        self.file = open(filename, 'w', encoding='utf-8')
+        self.file.write(json.dumps({'version': 'https://jsonfeed.org/version/1.1', 'title': title})[:-1])
+        self.file.write(', "items": [\n')
+        self.first = True
+
+    def write(self, record, key):
+        item = {'id': record['id'], 'date_published': _iso_time(key)}
+        if record.get('link'):
+            item['url'] = record['link']
+        if record.get('title'):
+            item['title'] = record['title']
+        item['content_html'] = record.get('html', '')
+        if record.get('thumbnail'):
+            item['image'] = record['thumbnail']
+        if record.get('author'):
+            author = {'name': record['author']}
+            if record.get('author_link'):
+                author['url'] = record['author_link']
+            if record.get('avatar'):
+                author['avatar'] = record['avatar']
+            item['authors'] = [author]
+        item['_feed_merger'] = {'source': record.get('source'), 'feed_title': record.get('feed_title')}
+
+        if not self.first:
+            self.file.write(',\n')
+        self.first = False
+        self.file.write(json.dumps(item, default=str))
+
+    def close(self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+class JsonLinesWriter:
+    def __init__(self, filename):
+        self.file = open(filename, 'w', encoding='utf-8')
+
+    def write(self, record, key):
+        self.file.write(json.dumps(record, default=str))
+        self.file.write('\n')
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,440 @@
+import hashlib
+import html
+import html.parser
+import json
+import marshal
+import os
+import sqlite3
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+# whether entry_template includes each entry's json in a comment
+inline_entry_json = True
+
+# bump when translate_html or the rendering around it changes its output, so
+# nothing rendered by an older version is used from the cache or the archive
+RENDER_VERSION = 2
+
+# stands in for fm:counter in cached items, the counter differs from run to
+# run even when the entry doesn't
+COUNTER_SENTINEL = 9006104071832581
+
+render_cache = None
+
+entry_template = """<h1><a name="item{e['fm:counter']}"></a><?if e.get('fm:link')><a href="{e['fm:link']}"><?endif><?if e.get('fm:avatar')><img src="{e['fm:avatar']}" height=48><?endif>{' - '.join(x for x in (e.get('fm:feedname') or f.get('fm:title'), e.get('fm:author'), e.get('fm:title')) if x) or e.get('fm:source')}<?if e.get('fm:link')></a><?endif> {e['fm:timestamp']} <a href="#item{e['fm:counter']}">[anchor]</a></h1>
+
+<?if inline_entry_json><?html <!-->
+<?html {json.dumps(e, indent=2).replace('--' + chr(62), '--\\\\' + chr(62))}>
+<?html --{chr(62)}><?endif>
+
+<?if e.get('fm:thumbnail')><p><img src="{e['fm:thumbnail']}" height="240"></p><?endif>
+
+<?if e.get('fm:html')><?html {translate_html(f, e, e['fm:html'])}><?endif>
+"""
+
+class TemplateCompiler(html.parser.HTMLParser):
+    # turns a template into the source of a render(e, f) function, every text
+    # node, attribute and <?html> is an f-string and errors in them are written
+    # into the output instead of failing the whole entry
+    def __init__(self):
+        super().__init__()
+        self.lines = ['def render(e, f):', ' strs = []', ' append = strs.append']
+        self.stack = []
+        self.indent = ' '
+
+    def get_source(self):
+        if self.stack:
+            raise Exception("template has <?if> without <?endif>")
+        return '\n'.join(self.lines + [' return "".join(strs)', ''])
+
+    def emit(self, line):
+        self.lines.append(self.indent + line)
+
+    def emit_text(self, text):
+        self.emit(f'append({text!r})')
+
+    def emit_eval(self, source, escape=True):
+        try:
+            compile(source, '<string>', 'eval')
+        except SyntaxError as exc:
+            self.emit_text(html.escape(str(exc)))
+            return
+        self.emit('try:')
+        if escape:
+            self.emit(f' append(html.escape(str({source}\n)))')
+        else:
+            self.emit(f' append(str({source}\n))')
+        self.emit('except Exception as exc:')
+        self.emit(' append(html.escape(str(exc)))')
+
+    def handle_starttag(self, tag, attrs, close=False):
+        self.emit_text('<' + tag)
+
+        for (key, value) in attrs:
+            self.emit_text(' ' + key + '="')
+            self.emit_eval(f'f"""{value}"""')
+            self.emit_text('"')
+
+        if close:
+            self.emit_text('/>')
+        else:
+            self.emit_text('>')
+
+    def handle_endtag(self, tag):
+        self.emit_text('</' + tag + '>')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, close=True)
+
+    def handle_data(self, data):
+        self.emit_eval(f'f"""{data}"""')
+
+    def handle_pi(self, data):
+        if ' ' in data:
+            name, rest = data.split(' ', 1)
+        else:
+            name = data
+            rest = ''
+
+        if name == 'if':
+            self.stack.append('if')
+            try:
+                compile(rest, '<string>', 'eval')
+            except SyntaxError as exc:
+                self.emit_text(html.escape(str(exc)))
+                self.emit('if False:')
+            else:
+                self.emit('try:')
+                self.emit(f' enabled = bool({rest}\n)')
+                self.emit('except Exception as exc:')
+                self.emit(' enabled = False')
+                self.emit(' append(html.escape(str(exc)))')
+                self.emit('if enabled:')
+            self.indent += ' '
+            self.emit('pass')
+        elif name == 'endif':
+            if not self.stack or self.stack.pop() != 'if':
+                raise Exception("template has <?endif> without <?if>")
+            self.indent = self.indent[:-1]
+        elif name == 'html':
+            self.emit_eval(f'f"""{rest}"""', escape=False)
+        else:
+            raise Exception(f"template has unknown processing instruction {name}")
+
+def compile_template(template):
+    compiler = TemplateCompiler()
+    compiler.feed(template)
+    compiler.close()
+    module_code = compile(compiler.get_source(), '<template>', 'exec')
+    for const in module_code.co_consts:
+        if isinstance(const, types.CodeType) and const.co_name == 'render':
+            return const
+
+def template_version(template):
+    return hashlib.sha256(f'{RENDER_VERSION}\0{template}'.encode('utf-8')).hexdigest()
+
+def load_template(template, cache_dir=None):
+    # returns a render(entry, feed) function, the compiled code is kept in
+    # cache_dir so a template is only compiled again when it changes
+    code = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f'{template_version(template)}.{sys.implementation.cache_tag}')
+        try:
+            with open(cache_path, 'rb') as f:
+                code = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    if code is None:
+        code = compile_template(template)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path + '.new', 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(cache_path + '.new', cache_path)
+
+    return types.FunctionType(code, globals(), 'render')
+
+_BODY_STYLES = {
+    'alink': 'div.styleID a:active { color: VAL; } ',
+    'vlink': 'div.styleID a:visited { color: VAL; } ',
+    'link': 'div.styleID a { color: VAL; } ',
+    'background': 'div.styleID { background: url("VAL"); }',
+    'bgcolor': 'div.styleID { background-color: VAL; }',
+    'bottommargin': 'div.styleID { margin-bottom: VAL; }',
+    'leftmargin': 'div.styleID { margin-left: VAL; }',
+    'topmargin': 'div.styleID { margin-top: VAL; }',
+    'rightmargin': 'div.styleID { margin-right: VAL; }',
+    'text': 'div.styleID { color: VAL; }',
+}
+
+class HtmlTranslator(html.parser.HTMLParser):
+    def __init__(self, base):
+        super().__init__()
+        self.strs = []
+        self.stack = []
+        self.base = base
+        self.location = None
+        self.output_enabled = True
+        self.in_divs = 0
+
+    def handle_starttag(self, tag, attrs):
+        body_to_div = False
+
+        if tag == 'html':
+            self.stack.append((self.location, self.output_enabled))
+            self.location = 'html'
+            self.output_enabled = False
+            return
+        if tag == 'head':
+            self.stack.append((self.location, self.output_enabled))
+            self.location = 'head'
+            self.output_enabled = False
+            return
+        if tag == 'body':
+            self.stack.append((self.location, self.output_enabled))
+            self.location = 'body'
+            self.output_enabled = True
+            tag = 'div'
+            body_to_div = True
+            style_str = []
+
+        if self.location == 'head' and tag == 'base':
+            attrs = dict(attrs)
+            if 'href' in attrs:
+                self.base = attrs['href']
+            return
+
+        if self.output_enabled:
+            if tag == 'div':
+                self.in_divs += 1
+            if not self.in_divs:
+                self.strs.append('<div>')
+                self.in_divs = 1
+            self.strs.append('<')
+            self.strs.append(tag)
+            for key, value in attrs:
+                if value and key in ('src', 'href'):
+                    value = urllib.parse.urljoin(self.base, value)
+                self.strs.append(' ')
+                self.strs.append(key)
+                if value:
+                    self.strs.append('="')
+                    self.strs.append(html.escape(value))
+                    self.strs.append('"')
+                    if body_to_div:
+                        if key in _BODY_STYLES:
+                            style_str.append(_BODY_STYLES[key].replace('VAL', value))
+            if body_to_div and style_str:
+                # named after the styles so the output doesn't depend on
+                # what was rendered before it
+                style_id = hashlib.sha256('\n'.join(style_str).encode('utf-8')).hexdigest()[:12]
+                style_str = [x.replace('div.styleID', f'div.style{style_id}') for x in style_str]
+                self.strs.append(f' class="style{style_id}"')
+            self.strs.append('>')
+            if body_to_div and style_str:
+                self.strs.append('<style>')
+                self.strs.append(html.escape('\n'.join(style_str)))
+                self.strs.append('</style>')
+
+    def handle_endtag(self, tag):
+        output_was_enabled = self.output_enabled
+        if tag == self.location:
+            self.location, self.output_enabled = self.stack.pop()
+
+        if tag == 'body':
+            tag = 'div'
+
+        if output_was_enabled:
+            if tag == 'div':
+                if self.in_divs:
+                    self.in_divs -= 1
+                else:
+                    return
+            self.strs.append('</')
+            self.strs.append(tag)
+            self.strs.append('>')
+
+    def handle_data(self, data):
+        if self.output_enabled:
+            self.strs.append(html.escape(data))
+
+    def get_contents(self):
+        while self.in_divs:
+            self.in_divs -= 1
+            self.strs.append('</div>')
+        return ''.join(self.strs)
+
+def translate_html(feed, entry, data):
+    if entry.get('fm:html_trusted') is True:
+        # markup we generated ourselves, with absolute urls and nothing for
+        # HtmlTranslator to take out
+        return f'<div>{data}</div>'
+
+    base = entry.get('fm:base', feed.get('fm:base', ''))
+
+    if render_cache is not None:
+        key = 'html:' + hashlib.sha256(f'{RENDER_VERSION}\0{base}\0{data}'.encode('utf-8', 'surrogatepass')).hexdigest()
+        contents = render_cache.get(key)
+        if contents is not None:
+            return contents
+
+    parser = HtmlTranslator(base)
+    parser.feed(data)
+    contents = parser.get_contents()
+
+    if render_cache is not None:
+        render_cache.put(key, contents)
+
+    return contents
+
+class RenderCache:
+    # rendered items and translated html kept between runs, keyed by a hash of
+    # what they were made from. the least recently used are dropped when they
+    # take more than max_size bytes
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, html TEXT, size INTEGER, used REAL);
+            CREATE INDEX IF NOT EXISTS items_used ON items (used);
+        """)
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT html FROM items WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE items SET used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key, html):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                (key, html, len(html.encode('utf-8', 'surrogatepass')), time.time()))
+
+    def evict(self):
+        with self.lock:
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM items').fetchone()[0]
+            if total <= self.max_size:
+                return
+
+            for (key, size) in self.db.execute('SELECT key, size FROM items ORDER BY used').fetchall():
+                self.db.execute('DELETE FROM items WHERE key = ?', (key,))
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+def open_render_cache(path, max_size):
+    global render_cache
+    render_cache = RenderCache(path, max_size)
+
+def close_render_cache():
+    global render_cache
+    if render_cache is not None:
+        render_cache.close()
+        render_cache = None
+
+def entry_key(version, entry):
+    entry_json = json.dumps(entry, sort_keys=True, default=str)
+    return 'item:' + hashlib.sha256(f'{RENDER_VERSION}\0{version}\0{entry_json}'.encode('utf-8', 'surrogatepass')).hexdigest()
+
+def _with_sentinel(entry):
+    if entry.get('fm:counter') is None:
+        return entry
+    entry = dict(entry)
+    entry['fm:counter'] = COUNTER_SENTINEL
+    return entry
+
+def with_counter(html, entry):
+    if entry.get('fm:counter') is None:
+        return html
+    return html.replace(str(COUNTER_SENTINEL), str(entry['fm:counter']))
+
+def render_cached(render, version, entry, feed, sentinel=False):
+    # version identifies the template, everything else the output depends on
+    # is in the entry, which includes its feed. with sentinel the html has
+    # COUNTER_SENTINEL in place of the counter, for with_counter to fill in
+    if render_cache is None:
+        return render(_with_sentinel(entry), feed) if sentinel else render(entry, feed)
+
+    sentinel_entry = _with_sentinel(entry)
+    key = entry_key(version, sentinel_entry)
+    html = render_cache.get(key)
+    if html is None:
+        html = render(sentinel_entry, feed)
+        render_cache.put(key, html)
+
+    return html if sentinel else with_counter(html, entry)
+
+# entries sent to a render worker at a time, lines with fewer entries than
+# this left to render are rendered in this process
+RENDER_CHUNK_SIZE = 16
+
+_worker_render = None
+
+def init_render_worker(template, inline):
+    global _worker_render, render_cache, inline_entry_json
+    # the cache belongs to the parent, which looks entries up before sending them
+    render_cache = None
+    inline_entry_json = inline
+    _worker_render = load_template(template)
+
+def render_chunk(entries):
+    # runs in a worker, returns the html of each entry or None if it failed,
+    # so the parent can render it again and report the error
+    result = []
+    for entry in entries:
+        try:
+            result.append(_worker_render(entry, entry.get('fm:feed', {})))
+        except:
+            result.append(None)
+    return result
+
+def render_many(render, version, entries, pool=None, sentinel=False):
+    # like render_cached for each entry, with the entries missing from the
+    # cache rendered in chunks on pool. the html comes back in entry order,
+    # None where rendering failed
+    results = [None] * len(entries)
+    todo = [] # index, cache key, entry with the sentinel counter
+    for i, entry in enumerate(entries):
+        sentinel_entry = _with_sentinel(entry)
+        key = entry_key(version, sentinel_entry) if render_cache is not None else None
+        html = render_cache.get(key) if key is not None else None
+        if html is not None:
+            results[i] = html
+        else:
+            todo.append((i, key, sentinel_entry))
+
+    if pool is None or len(todo) <= RENDER_CHUNK_SIZE:
+        rendered = []
+        for (i, key, sentinel_entry) in todo:
+            try:
+                rendered.append(render(sentinel_entry, sentinel_entry.get('fm:feed', {})))
+            except:
+                rendered.append(None)
+    else:
+        chunks = [[sentinel_entry for (i, key, sentinel_entry) in todo[pos:pos+RENDER_CHUNK_SIZE]]
+            for pos in range(0, len(todo), RENDER_CHUNK_SIZE)]
+        rendered = [html for chunk in pool.map(render_chunk, chunks) for html in chunk]
+
+    for (i, key, sentinel_entry), html in zip(todo, rendered):
+        if html is not None and key is not None:
+            render_cache.put(key, html)
+        results[i] = html
+
+    if sentinel:
+        return results
+    return [with_counter(html, entry) if html is not None else None for html, entry in zip(results, entries)]
+
@@ -0,0 +1,247 @@
+import ast
+import collections.abc
+import os
+import sqlite3
+import threading
+import time
+
+import core
+
+LEGACY_FILENAME = 'feed-merger-state'
+SQLITE_FILENAME = 'feed-merger-state.db'
+
+class FileState(dict):
+    # the original format, the whole dict written out with repr
+    def __init__(self, filename=LEGACY_FILENAME):
+        super().__init__()
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.update(eval(f.read()))
+        except FileNotFoundError:
+            pass
+
+    def commit(self):
+        state_str = repr(dict(self))
+        eval(state_str)
+
+        with open(self.filename + '.new', 'w') as f:
+            f.write(state_str)
+
+        os.replace(self.filename + '.new', self.filename)
+
+    def close(self):
+        pass
+
+_MISSING = object()
+
+class SqliteState(collections.abc.MutableMapping):
+    # keys and values are stored as their repr, values are only read from the
+    # database when first used and only the ones that changed are written back
+    def __init__(self, filename=SQLITE_FILENAME):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        self.values = {} # key: value, or _MISSING if not in the database
+        self.stored = {} # key: repr of the value in the database
+
+    def _load(self, key):
+        if key not in self.values:
+            row = self.db.execute('SELECT value FROM state WHERE key = ?', (repr(key),)).fetchone()
+            if row is None:
+                self.values[key] = _MISSING
+            else:
+                self.values[key] = ast.literal_eval(row[0])
+                self.stored[key] = row[0]
+        return self.values[key]
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self._load(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            if self._load(key) is _MISSING:
+                raise KeyError(key)
+            self.values[key] = _MISSING
+
+    def __iter__(self):
+        with self.lock:
+            keys = {ast.literal_eval(key) for (key,) in self.db.execute('SELECT key FROM state')}
+            keys.update(self.values)
+            return iter([key for key in keys if self._load(key) is not _MISSING])
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def commit(self):
+        with self.lock, self.db:
+            for key, value in self.values.items():
+                if value is _MISSING:
+                    if key in self.stored:
+                        self.db.execute('DELETE FROM state WHERE key = ?', (repr(key),))
+                        del self.stored[key]
+                    continue
+
+                # compare the repr so values changed in place are saved too
+                value_str = repr(value)
+                if self.stored.get(key) == value_str:
+                    continue
+                ast.literal_eval(value_str)
+                self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (repr(key), value_str))
+                self.stored[key] = value_str
+
+    def close(self):
+        self.db.close()
+
+# namespaces holding per-source state, which can go once the source is gone
+SOURCE_NAMESPACES = {
+    'atom', 'bluesky', 'bluesky-notifications', 'codeweavers', 'github', 'gitlab', 'gmail',
+    'mastodon', 'mbox', 'mcstories', 'nebula', 'ondisneyplus', 'reddit', 'rss', 'soundcloud',
+    'soundgasm', 'web',
+}
+
+# logins are shared between sources, so they are kept regardless
+CREDENTIAL_NAMES = {'client_credentials', 'client_creds', 'refresh_token', 'session', 'token'}
+
+# namespaces written with core.set_expiring: (ttl, miss ttl)
+EXPIRING_NAMESPACES = {
+    'author': (core.AUTHOR_TTL, core.AUTHOR_MISS_TTL),
+    'favicon': (core.FAVICON_TTL, core.FAVICON_MISS_TTL),
+}
+
+def is_source_key(key):
+    return isinstance(key, tuple) and bool(key) and key[0] in SOURCE_NAMESPACES and key[-1] not in CREDENTIAL_NAMES
+
+class LineState(collections.abc.MutableMapping):
+    # the state as one line sees it, the source keys the line has stored or
+    # found are recorded under ('keys', line) so compact knows which line
+    # they belong to, even on runs where the line fails before using them
+    def __init__(self, state, line):
+        self.state = state
+        self.line = line
+        self.recorded = set()
+
+    def _record(self, key):
+        if key in self.recorded or not is_source_key(key):
+            return
+        self.recorded.add(key)
+        with core.lock('keys', self.line):
+            keys = self.state.get(('keys', self.line)) or []
+            if key not in keys:
+                self.state['keys', self.line] = keys + [key]
+
+    def __getitem__(self, key):
+        value = self.state[key]
+        self._record(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.state[key] = value
+        self._record(key)
+
+    def __delitem__(self, key):
+        del self.state[key]
+
+    def __iter__(self):
+        return iter(self.state)
+
+    def __len__(self):
+        return len(self.state)
+
+    def __getattr__(self, name):
+        return getattr(self.state, name)
+
+def compact(state, lines, cap):
+    # lines is every line reachable from the feed list, a source key goes once
+    # none of the lines recorded as using it are reachable. keys that no line
+    # has recorded yet are kept
+    removed = capped = 0
+    now = time.time()
+
+    owners = {}
+    for key in list(state):
+        if isinstance(key, tuple) and len(key) == 2 and key[0] == 'keys':
+            for owned in state[key]:
+                owners.setdefault(owned, set()).add(key[1])
+
+    for key in list(state):
+        if not isinstance(key, tuple) or not key:
+            continue
+        namespace = key[0]
+
+        if namespace == 'keys':
+            if key[1] not in lines:
+                del state[key]
+            continue
+
+        if namespace in EXPIRING_NAMESPACES:
+            value, checked = state[key]
+            ttl, miss_ttl = EXPIRING_NAMESPACES[namespace]
+            if now - checked > (ttl if value is not None else miss_ttl):
+                del state[key]
+                removed += 1
+            continue
+
+        if not is_source_key(key):
+            continue
+
+        if key in owners and not owners[key] & lines:
+            del state[key]
+            removed += 1
+            continue
+
+        value = state[key]
+        if isinstance(value, (list, tuple)) and len(value) > cap:
+            state[key] = value[:cap]
+            capped += 1
+
+    # forget the keys that are gone
+    for key in list(state):
+        if isinstance(key, tuple) and len(key) == 2 and key[0] == 'keys':
+            keys = [owned for owned in state[key] if owned in state]
+            if keys != state[key]:
+                state[key] = keys
+
+    print(f"Compacted state: removed {removed} keys, capped {capped} values")
+
+def report(state):
+    sizes = {}
+    for key in state:
+        namespace = key[0] if isinstance(key, tuple) and key else repr(key)
+        count, size = sizes.get(namespace, (0, 0))
+        sizes[namespace] = count + 1, size + len(repr(key)) + len(repr(state[key]))
+
+    total_count = sum(count for count, size in sizes.values())
+    total_size = sum(size for count, size in sizes.values())
+    print(f"state: {total_count} keys, {total_size} bytes")
+    for namespace, (count, size) in sorted(sizes.items(), key=lambda x: -x[1][1]):
+        print(f"  {namespace:24} {count:6} keys {size:10} bytes")
+
+def open_state(backend='sqlite'):
+    if backend == 'file':
+        return FileState()
+
+    if not os.path.exists(SQLITE_FILENAME) and os.path.exists(LEGACY_FILENAME):
+        # migrate from the old format, keeping the file around as a backup
+        legacy = FileState()
+        state = SqliteState(SQLITE_FILENAME + '.new')
+        state.update(legacy)
+        state.commit()
+        state.close()
+        os.replace(SQLITE_FILENAME + '.new', SQLITE_FILENAME)
+        os.replace(LEGACY_FILENAME, LEGACY_FILENAME + '.bak')
+        print(f"Migrated {len(legacy)} keys from {LEGACY_FILENAME} to {SQLITE_FILENAME}")
+
+    return SqliteState()
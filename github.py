@@ -4,19 +4,21 @@ import urllib.parse
 import urllib.error
 
 import core
+import fm_http
 
 from html import escape as e
 
 def get_token(state, force=False):
-    if not force and state.get(('github', 'token')):
-        return state['github', 'token']
+    with core.lock('github', 'token'):
+        if not force and state.get(('github', 'token')):
+            return state['github', 'token']
 
-    print("Please visit https://docs.github.com/en/authentication/keeping-your-account-and-data-secure/managing-your-personal-access-tokens#creating-a-fine-grained-personal-access-token and follow the instructions to create an access token")
-    print("The token doesn't need any permissions beyond read-only access to any repositories you want to follow.")
-    token = input("Enter token: ")
+        print("Please visit https://docs.github.com/en/authentication/keeping-your-account-and-data-secure/managing-your-personal-access-tokens#creating-a-fine-grained-personal-access-token and follow the instructions to create an access token")
+        print("The token doesn't need any permissions beyond read-only access to any repositories you want to follow.")
+        token = input("Enter token: ")
 
-    state['github', 'token'] = token
-    return token
+        state['github', 'token'] = token
+        return token
 
 def api_request(state, url, data=None):
     token = get_token(state)
@@ -27,7 +29,7 @@ def api_request(state, url, data=None):
             'Accept': 'application/vnd.github+json',
             'X-GitHub-Api-Version': '2022-11-28',
         })
-        return urllib.request.urlopen(req)
+        return fm_http.urlopen(req)
     except urllib.error.HTTPError as e:
         if e.code == 401:
             token = get_token(state, force = True)
@@ -37,7 +39,7 @@ def api_request(state, url, data=None):
                 'Accept': 'application/vnd.github+json',
                 'X-GitHub-Api-Version': '2022-11-28',
             })
-            return urllib.request.urlopen(req)
+            return fm_http.urlopen(req)
         raise
 
 def process_branch(line, state, items):
@@ -5,23 +5,25 @@ import urllib.request
 
 import core
 import fm_email
+import fm_http
 
 from html import escape as e
 
 def get_token(url, state, force = False):
-    host = urllib.parse.urlparse(url)._replace(fragment="", query="", path="").geturl()
+    with core.lock('gitlab', 'token'):
+        host = urllib.parse.urlparse(url)._replace(fragment="", query="", path="").geturl()
 
-    if not force:
-        return state.get(('gitlab', host, 'token'))
+        if not force:
+            return state.get(('gitlab', host, 'token'))
 
-    token_pref_url = urllib.parse.urlparse(url)._replace(fragment="", query="", path="/-/user_settings/personal_access_tokens").geturl()
+        token_pref_url = urllib.parse.urlparse(url)._replace(fragment="", query="", path="/-/user_settings/personal_access_tokens").geturl()
 
-    print(f"Please generate a token at {token_pref_url}")
-    print("It should have the read_api scope")
-    token = input("Enter token: ")
+        print(f"Please generate a token at {token_pref_url}")
+        print("It should have the read_api scope")
+        token = input("Enter token: ")
 
-    state['gitlab', host, 'token'] = token
-    return token
+        state['gitlab', host, 'token'] = token
+        return token
 
 def api_request(state, url, data = None):
     token = get_token(url, state)
@@ -33,7 +35,7 @@ def api_request(state, url, data = None):
             })
         else:
             req = urllib.request.Request(url, data = data)
-        return urllib.request.urlopen(req)
+        return fm_http.urlopen(req)
     except urllib.error.HTTPError as e:
         if e.code == 401:
             token = get_token(url, state, force = True)
@@ -41,7 +43,7 @@ def api_request(state, url, data = None):
             req = urllib.request.Request(url, data = data, headers = {
                 'Authorization': 'Bearer ' + token,
             })
-            return urllib.request.urlopen(req)
+            return fm_http.urlopen(req)
         elif e.code == 404:
             response = input(f"{url} returned 404 error. This could either be because the resource really doesn't exist, or because it's private and you don't have permission to view it. Attempt to log in?[Y/n] ")
             if response.lower() in ('', 'y', 'yes'):
@@ -50,7 +52,7 @@ def api_request(state, url, data = None):
                 req = urllib.request.Request(url, data = data, headers = {
                     'Authorization': 'Bearer ' + token,
                 })
-                return urllib.request.urlopen(req)
+                return fm_http.urlopen(req)
         raise
 
 def process_branch(line, state, items):
@@ -109,7 +111,7 @@ def process_branch(line, state, items):
             commit['fm:author'] = commit['author_name']
             commit['fm:timestamp'] = commit['created_at']
 
-            avatar = fm_email.get_avatar(commit['author_email'])
+            avatar = fm_email.get_avatar(commit['author_email'], state=state)
             if avatar:
                 commit['fm:avatar'] = avatar
 
@@ -4,51 +4,53 @@ import urllib.parse
 import urllib.request
 
 import core
+import fm_http
 
 def get_token(server_url, state):
-    if ('mastodon', server_url, 'token') in state:
-        return state[('mastodon', server_url, 'token')]
-
-    scope = 'read:statuses read:lists'
-
-    # register application
-    register_url = urllib.parse.urlparse(server_url)._replace(path="/api/v1/apps").geturl()
-    register_data = urllib.parse.urlencode({
-        'client_name': 'feed-merger',
-        'redirect_uris': 'urn:ietf:wg:oauth:2.0:oob',
-        'scopes': scope,
-        'website': 'https://madewokherd.nfshost.com/omgsecret/feed-merger.txt',
-    }).encode('utf8')
-    register_response = json.load(urllib.request.urlopen(register_url, data=register_data))
-
-    # authorize (log in as user)
-    authorize_query = urllib.parse.urlencode({
-        'response_type': 'code',
-        'client_id': register_response['client_id'],
-        'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
-        'scope': scope,
-    })
-    authorize_url = urllib.parse.urlparse(server_url)._replace(path="/oauth/authorize", query=authorize_query).geturl()
-
-    print("Please visit this website:", authorize_url)
-    oauth_code = input("Enter OAuth code: ")
-
-    # get token
-    token_url = urllib.parse.urlparse(server_url)._replace(path="/oauth/token").geturl()
-    token_data = urllib.parse.urlencode({
-        'grant_type': 'authorization_code',
-        'code': oauth_code,
-        'client_id': register_response['client_id'],
-        'client_secret': register_response['client_secret'],
-        'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
-        'scope': scope,
-    }).encode('utf8')
-    token_response = json.load(urllib.request.urlopen(token_url, data=token_data))
-
-    token = token_response['access_token']
-    state[('mastodon', server_url, 'token')] = token
-
-    return token
+    with core.lock('mastodon', server_url, 'token'):
+        if ('mastodon', server_url, 'token') in state:
+            return state[('mastodon', server_url, 'token')]
+
+        scope = 'read:statuses read:lists'
+
+        # register application
+        register_url = urllib.parse.urlparse(server_url)._replace(path="/api/v1/apps").geturl()
+        register_data = urllib.parse.urlencode({
+            'client_name': 'feed-merger',
+            'redirect_uris': 'urn:ietf:wg:oauth:2.0:oob',
+            'scopes': scope,
+            'website': 'https://madewokherd.nfshost.com/omgsecret/feed-merger.txt',
+        }).encode('utf8')
+        register_response = json.load(fm_http.urlopen(register_url, data=register_data))
+
+        # authorize (log in as user)
+        authorize_query = urllib.parse.urlencode({
+            'response_type': 'code',
+            'client_id': register_response['client_id'],
+            'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
+            'scope': scope,
+        })
+        authorize_url = urllib.parse.urlparse(server_url)._replace(path="/oauth/authorize", query=authorize_query).geturl()
+
+        print("Please visit this website:", authorize_url)
+        oauth_code = input("Enter OAuth code: ")
+
+        # get token
+        token_url = urllib.parse.urlparse(server_url)._replace(path="/oauth/token").geturl()
+        token_data = urllib.parse.urlencode({
+            'grant_type': 'authorization_code',
+            'code': oauth_code,
+            'client_id': register_response['client_id'],
+            'client_secret': register_response['client_secret'],
+            'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
+            'scope': scope,
+        }).encode('utf8')
+        token_response = json.load(fm_http.urlopen(token_url, data=token_data))
+
+        token = token_response['access_token']
+        state[('mastodon', server_url, 'token')] = token
+
+        return token
 
 def account_name(account):
     return account.get('display_name') or account.get('username') or ''
@@ -58,11 +60,11 @@ def format_status(status, link, reblog_author):
     html_end_parts = []
 
     if reblog_author:
-        html_parts.append(f"<p><img src=\"{reblog_author['avatar']}\" width=16 height=16> {account_name(reblog_author)} boosted:</p>")
+        html_parts.append(f"<p><img src=\"{reblog_author['avatar']}\" width=16 height=16> {html.escape(account_name(reblog_author))} boosted:</p>")
 
     if status.get('in_reply_to_id'):
         reply_link = urllib.parse.urlparse(link)._replace(fragment="", query="", path=f"/web/statuses/{status['in_reply_to_id']}").geturl()
-        html_parts.append(f"<p><img src=\"{status['account']['avatar']}\" width=16 height=16> {account_name(status['account'])} replied to <a href=\"{reply_link}\">a post</a></p>")
+        html_parts.append(f"<p><img src=\"{status['account']['avatar']}\" width=16 height=16> {html.escape(account_name(status['account']))} replied to <a href=\"{reply_link}\">a post</a></p>")
 
     if status.get('spoiler_text'):
         html_parts.append(f"<details><summary>{html.escape(status['spoiler_text'])}</summary>")
@@ -90,9 +92,9 @@ def format_status(status, link, reblog_author):
     a = status.get('card')
     if a:
         if a.get('author_name'):
-            html_parts.append(f"<p>[{a.get('provider_name')}] {a['author_name']} - {a.get('title')}</p>")
+            html_parts.append(f"<p>[{html.escape(str(a.get('provider_name')))}] {html.escape(a['author_name'])} - {html.escape(str(a.get('title')))}</p>")
         else:
-            html_parts.append(f"<p>[{a.get('provider_name')}] {a.get('title')}</p>")
+            html_parts.append(f"<p>[{html.escape(str(a.get('provider_name')))}] {html.escape(str(a.get('title')))}</p>")
         if a.get('image'):
             html_parts.append(f"""<p><a href=\"{a['url']}\"><img src=\"{a['image']}\" style="max-height: 100vh; max-width: 100vw"></a></p>""")
         if a.get('description'):
@@ -166,7 +168,7 @@ def process(line, state):
         query_url = timeline_parse._replace(query = urllib.parse.urlencode(query_dict)).geturl()
 
         query_request = urllib.request.Request(query_url, headers = {'Authorization': 'Bearer ' + token})
-        json_response = json.load(urllib.request.urlopen(query_request))
+        json_response = json.load(fm_http.urlopen(query_request))
 
         if new_since_id is None and json_response:
             new_since_id = json_response[0]['id']
@@ -192,6 +194,8 @@ def process(line, state):
         item['fm:title'] = main_item['account']['acct']
         item['fm:timestamp'] = item['created_at']
 
+        # the status content is html from the server, so it still goes
+        # through HtmlTranslator
         item['fm:html'] = format_status(main_item, item['fm:link'], reblog_author)
 
     if new_since_id:
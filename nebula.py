@@ -3,6 +3,7 @@ import urllib.parse
 import urllib.request
 
 import core
+import fm_http
 
 from html import escape as e
 
@@ -18,7 +19,7 @@ def process(line, state, items):
     result = None
 
     while True:
-        j = json.load(urllib.request.urlopen(page_url))
+        j = json.load(fm_http.urlopen(page_url))
 
         if result is None:
             result = j
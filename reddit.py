@@ -12,6 +12,7 @@ import urllib.request
 
 import agegate
 import core
+import fm_http
 
 from html import escape as e
 
@@ -41,90 +42,92 @@ class OAuthHandler(http.server.BaseHTTPRequestHandler):
         _thread.start_new_thread(self.server.shutdown, ())
 
 def get_client_creds(state):
-    if ('reddit', 'client_creds') in state:
-        return state['reddit', 'client_creds']
+    with core.lock('reddit', 'client_creds'):
+        if ('reddit', 'client_creds') in state:
+            return state['reddit', 'client_creds']
 
-    print("Hi, I'm going to need client credentials to function. You can either contact u/migratingwoks for this, or generate them at https://www.reddit.com/prefs/apps (you can also use that page to revoke this app's access in the future).")
-    client_id = input("Enter client ID: ")
-    client_secret = input('Enter client secret (leave this blank if client ID is for an "installed app"): ')
+        print("Hi, I'm going to need client credentials to function. You can either contact u/migratingwoks for this, or generate them at https://www.reddit.com/prefs/apps (you can also use that page to revoke this app's access in the future).")
+        client_id = input("Enter client ID: ")
+        client_secret = input('Enter client secret (leave this blank if client ID is for an "installed app"): ')
 
-    state['reddit', 'client_creds'] = client_id, client_secret
-    return client_id, client_secret
+        state['reddit', 'client_creds'] = client_id, client_secret
+        return client_id, client_secret
 
 def get_token(state, force=False):
-    if not force and state.get(('reddit', 'token')):
-        return state['reddit', 'token']
+    with core.lock('reddit', 'token'):
+        if not force and state.get(('reddit', 'token')):
+            return state['reddit', 'token']
+
+        client_id, client_secret = get_client_creds(state)
+
+        client_auth_token = base64.b64encode(f'{client_id}:{client_secret}'.encode('utf8')).decode('ascii')
+        client_auth_header = {'Authorization': 'Basic ' + client_auth_token, 'User-Agent': _USER_AGENT}
+
+        if state.get(('reddit', 'refresh_token')):
+            refresh_token = state['reddit', 'refresh_token']
+            refresh_url = "https://www.reddit.com/api/v1/access_token"
+            refresh_data = urllib.parse.urlencode({
+                'client_id': client_id,
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token,
+            }).encode('utf8')
+            try:
+                req = urllib.request.Request(refresh_url, data=refresh_data, headers=client_auth_header)
+                token_response = json.load(fm_http.urlopen(req))
+            except urllib.error.HTTPError as e:
+                if e.code != 401:
+                    raise
+            else:
+                token = token_response['access_token']
+                state[('reddit', 'token')] = token
+
+                return token
 
-    client_id, client_secret = get_client_creds(state)
+        scope = "read"
 
-    client_auth_token = base64.b64encode(f'{client_id}:{client_secret}'.encode('utf8')).decode('ascii')
-    client_auth_header = {'Authorization': 'Basic ' + client_auth_token, 'User-Agent': _USER_AGENT}
+        global _oauth_state
+        global _oauth_code
+        global _oauth_error
+        _oauth_state = secrets.token_urlsafe()
+        _oauth_code = None
+        _oauth_error = None
 
-    if state.get(('reddit', 'refresh_token')):
-        refresh_token = state['reddit', 'refresh_token']
-        refresh_url = "https://www.reddit.com/api/v1/access_token"
-        refresh_data = urllib.parse.urlencode({
+        authorize_query = urllib.parse.urlencode({
             'client_id': client_id,
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token,
+            'response_type': 'code',
+            'state': _oauth_state,
+            'redirect_uri': 'http://localhost:8080',
+            'duration': 'permanent',
+            'scope': scope,
+        })
+        authorize_url = urllib.parse.urlparse("https://www.reddit.com/api/v1/authorize")._replace(query=authorize_query).geturl()
+
+        print(f"Please visit this website and login:", authorize_url)
+
+        # start server and wait for code
+        httpd = http.server.HTTPServer(('localhost', 8080), OAuthHandler)
+        httpd.serve_forever()
+
+        if _oauth_error is not None:
+            raise Exception(_oauth_error)
+
+        code = _oauth_code
+
+        # get token
+        token_url = "https://www.reddit.com/api/v1/access_token"
+        token_data = urllib.parse.urlencode({
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': 'http://localhost:8080',
         }).encode('utf8')
-        try:
-            req = urllib.request.Request(refresh_url, data=refresh_data, headers=client_auth_header)
-            token_response = json.load(urllib.request.urlopen(req))
-        except urllib.error.HTTPError as e:
-            if e.code != 401:
-                raise
-        else:
-            token = token_response['access_token']
-            state[('reddit', 'token')] = token
-
-            return token
-
-    scope = "read"
-
-    global _oauth_state
-    global _oauth_code
-    global _oauth_error
-    _oauth_state = secrets.token_urlsafe()
-    _oauth_code = None
-    _oauth_error = None
-
-    authorize_query = urllib.parse.urlencode({
-        'client_id': client_id,
-        'response_type': 'code',
-        'state': _oauth_state,
-        'redirect_uri': 'http://localhost:8080',
-        'duration': 'permanent',
-        'scope': scope,
-    })
-    authorize_url = urllib.parse.urlparse("https://www.reddit.com/api/v1/authorize")._replace(query=authorize_query).geturl()
-
-    print(f"Please visit this website and login:", authorize_url)
-
-    # start server and wait for code
-    httpd = http.server.HTTPServer(('localhost', 8080), OAuthHandler)
-    httpd.serve_forever()
-
-    if _oauth_error is not None:
-        raise Exception(_oauth_error)
-
-    code = _oauth_code
-
-    # get token
-    token_url = "https://www.reddit.com/api/v1/access_token"
-    token_data = urllib.parse.urlencode({
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': 'http://localhost:8080',
-    }).encode('utf8')
-    req = urllib.request.Request(token_url, headers=client_auth_header)
-    token_response = json.load(urllib.request.urlopen(req, data=token_data))
+        req = urllib.request.Request(token_url, headers=client_auth_header)
+        token_response = json.load(fm_http.urlopen(req, data=token_data))
 
-    token = token_response['access_token']
-    state[('reddit', 'token')] = token
-    state[('reddit', 'refresh_token')] = token_response['refresh_token']
+        token = token_response['access_token']
+        state[('reddit', 'token')] = token
+        state[('reddit', 'refresh_token')] = token_response['refresh_token']
 
-    return token
+        return token
 
 def api_request(state, url):
     token = get_token(state)
@@ -132,12 +135,12 @@ def api_request(state, url):
     req = urllib.request.Request(url, headers = {'Authorization': 'Bearer ' + token, 'User-Agent': _USER_AGENT})
 
     try:
-        return json.load(urllib.request.urlopen(req))
+        return json.load(fm_http.urlopen(req))
     except urllib.error.HTTPError as e:
         if e.code == 401:
             token = get_token(state, True)
             req = urllib.request.Request(url, headers = {'Authorization': 'Bearer ' + token, 'User-Agent': _USER_AGENT})
-            return json.load(urllib.request.urlopen(req))
+            return json.load(fm_http.urlopen(req))
         print(e.fp.read())
         raise
 
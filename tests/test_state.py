@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fm_state
+
+BRANCH_LINE = 'github-branch:owner/repo/main'
+BRANCH_KEY = ('github', 'branch', 'owner', 'repo', 'main', 'since')
+MAILBOX_LINE = 'gmail:user@example.com/in:inbox'
+MAILBOX_KEY = ('gmail', 'user@example.com', 'in:inbox', 'latest_id')
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'state.db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_lines(self, lines):
+        # one run where each line stores its cursor, which never mentions the line
+        state = fm_state.SqliteState(self.filename)
+        for line, key in lines:
+            fm_state.LineState(state, line)[key] = '2024-01-01'
+        state.commit()
+        state.close()
+
+    def compact(self, lines):
+        # a run where none of the lines got as far as using the state
+        state = fm_state.SqliteState(self.filename)
+        fm_state.compact(state, lines, 5000)
+        state.commit()
+        state.close()
+        state = fm_state.SqliteState(self.filename)
+        result = dict(state)
+        state.close()
+        return result
+
+    def test_failing_reachable_line_keeps_its_keys(self):
+        self.run_lines([(BRANCH_LINE, BRANCH_KEY), (MAILBOX_LINE, MAILBOX_KEY)])
+        result = self.compact({BRANCH_LINE, MAILBOX_LINE})
+        self.assertEqual(result[BRANCH_KEY], '2024-01-01')
+        self.assertEqual(result[MAILBOX_KEY], '2024-01-01')
+
+    def test_unreachable_line_loses_its_keys(self):
+        self.run_lines([(BRANCH_LINE, BRANCH_KEY), (MAILBOX_LINE, MAILBOX_KEY)])
+        result = self.compact({BRANCH_LINE})
+        self.assertIn(BRANCH_KEY, result)
+        self.assertNotIn(MAILBOX_KEY, result)
+        self.assertNotIn(('keys', MAILBOX_LINE), result)
+
+    def test_shared_key_kept_while_any_owner_is_reachable(self):
+        self.run_lines([(BRANCH_LINE, BRANCH_KEY), (MAILBOX_LINE, BRANCH_KEY)])
+        result = self.compact({MAILBOX_LINE})
+        self.assertIn(BRANCH_KEY, result)
+
+    def test_unrecorded_keys_are_kept(self):
+        state = fm_state.SqliteState(self.filename)
+        state[BRANCH_KEY] = '2024-01-01'
+        state.commit()
+        state.close()
+        self.assertIn(BRANCH_KEY, self.compact(set()))
+
+    def test_credentials_are_not_recorded(self):
+        state = fm_state.SqliteState(self.filename)
+        fm_state.LineState(state, MAILBOX_LINE)['gmail', 'user@example.com', 'token'] = 'secret'
+        self.assertNotIn(('keys', MAILBOX_LINE), state)
+        state.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import web
+
+# documents both backends have to turn into the same tokens
+CORPUS = [
+    '<p>hello <b>world</b></p>',
+    'plain text',
+    '<!DOCTYPE html><html><head><title>t</title></head><body><p>x</p></body></html>',
+    '<!doctype html><html lang="en">\n<head>\n<meta charset="utf-8">\n<title>A page</title>\n</head>\n'
+        '<body>\n<h1>Heading</h1>\n<p>Some <a href="/x">link</a> text.</p>\n</body>\n</html>',
+    '<html><body><p>no head</p></body></html>',
+    '<body><p>no html</p></body>',
+    '<meta charset="utf-8"><title>T</title><a href="/x">y</a><img src="a.png" alt="b">',
+    '<!-- c --><div class="a b" id=x>t &amp; u &lt; v</div>',
+    '<script>if (a < b) {}</script><style>p > a { color: red; }</style>',
+    '<article class="audible"><a itemprop="url" href="/t">Track</a>'
+        '<time pubdate="">2024-01-01</time><meta itemprop="duration" content="PT1M"></article>',
+    '<ul><li>one</li><li>two <em>2</em></li></ul><table><tr><td>cell</td></tr></table>',
+]
+
+# markup libxml2 repairs, where the backends are known to differ
+REPAIRED = [
+    '<div><p>a<p>b</div></div>', # adds </p>, drops the stray </div>
+    '<input disabled>', # gives the attribute a value
+    '<br/>', # self-closing tags have no end tag
+    '<!doctype html>\n<html></html>\n', # drops whitespace outside of <html>
+]
+
+def tokenize(tokenizer, data, chunk_size=None):
+    if chunk_size is None:
+        tokenizer.feed(data)
+    else:
+        for pos in range(0, len(data), chunk_size):
+            tokenizer.feed(data[pos:pos+chunk_size])
+    tokenizer.close()
+    return list(tokenizer.tokens)
+
+class DefaultBackendTest(unittest.TestCase):
+    def test_stdlib_by_default(self):
+        self.assertEqual(web.tokenizer_backend, 'stdlib')
+        self.assertIsInstance(web.HtmlTokenizer(), web.StdlibTokenizer)
+
+@unittest.skipIf(web.lxml is None, "lxml is not installed")
+class ConformanceTest(unittest.TestCase):
+    def test_corpus(self):
+        for data in CORPUS:
+            with self.subTest(data=data):
+                self.assertEqual(tokenize(web.LxmlTokenizer(), data), tokenize(web.StdlibTokenizer(), data))
+
+    def test_corpus_in_pieces(self):
+        for data in CORPUS:
+            with self.subTest(data=data):
+                self.assertEqual(tokenize(web.LxmlTokenizer(), data, 5), tokenize(web.StdlibTokenizer(), data))
+
+    def test_repaired_markup_differs(self):
+        # if these start matching, lxml could become the default again
+        for data in REPAIRED:
+            with self.subTest(data=data):
+                self.assertNotEqual(tokenize(web.LxmlTokenizer(), data), tokenize(web.StdlibTokenizer(), data))
+
+    def test_backend_setting(self):
+        old = web.tokenizer_backend
+        try:
+            web.tokenizer_backend = 'lxml'
+            self.assertIsInstance(web.HtmlTokenizer(), web.LxmlTokenizer)
+            self.assertIsInstance(web.HtmlTokenizer(cdata=[], rcdata=[]), web.StdlibTokenizer)
+        finally:
+            web.tokenizer_backend = old
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,23 @@
+import bisect
+import codecs
+import concurrent.futures
 import datetime
 import email.utils
 import html.parser
+import json
+import re
 import urllib.error
 import urllib.parse
 import urllib.request
+import xml.parsers.expat
+
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
 
 import core
+import fm_http
 
 # token values:
 STARTTAG = 'STARTTAG'
@@ -16,9 +28,164 @@ DECL = 'DECL'
 PI = 'PI'
 UNKNOWN = 'UNKNOWN'
 
-class HtmlTokenizer(html.parser.HTMLParser):
+# elements which never have content, so their end tag is optional
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+_SELECTOR_TOKEN = re.compile(r'''(\s*,\s*)|(\s+)|([\w:-]+|\*)|\.([\w-]+)|\[\s*([^\s~*^$=\]]+)\s*(?:([~*^$]?=)\s*(?:"([^"]*)"|'([^']*)'|([^\]\s]*))\s*)?\]''')
+
+_selectors = {}
+
+def parse_selector(selector):
+    # a small subset of css: tag, .class, [attr], [attr=value] with ~= *= ^= $=,
+    # descendants separated by spaces and alternatives separated by commas.
+    # returns a list of alternatives, each a list of (tag, conditions)
+    if selector in _selectors:
+        return _selectors[selector]
+
+    alternatives = [[]]
+    compound = None
+    pos = 0
+    text = selector.strip()
+    while pos < len(text):
+        m = _SELECTOR_TOKEN.match(text, pos)
+        if not m:
+            raise ValueError(f"Invalid selector: {selector!r}")
+        pos = m.end()
+        comma, space, tag, cls, attr, op, dq_value, sq_value, value = m.groups()
+
+        if comma:
+            alternatives.append([])
+            compound = None
+            continue
+        if space:
+            compound = None
+            continue
+
+        if compound is None:
+            compound = [None, []]
+            alternatives[-1].append(compound)
+
+        if tag:
+            if compound[0] is not None or compound[1]:
+                raise ValueError(f"Invalid selector: {selector!r}")
+            compound[0] = tag.lower() if tag != '*' else None
+        elif cls:
+            compound[1].append(('class', '~=', cls))
+        else:
+            if dq_value is not None:
+                value = dq_value
+            elif sq_value is not None:
+                value = sq_value
+            compound[1].append((attr.lower(), op, value))
+
+    if not all(alternatives):
+        raise ValueError(f"Invalid selector: {selector!r}")
+
+    _selectors[selector] = alternatives
+    return alternatives
+
+class TokenDocument(list):
+    # the token list from HtmlTokenizer, which also indexes start and end tags
+    # by name and keeps the attributes of start tags as dicts once asked for
+    def __init__(self):
+        super().__init__()
+        self.start_tags = {} # tagname: positions of its start tags
+        self.end_tags = {} # tagname: positions of its end tags
+        self.all_start_tags = []
+        self.attr_dicts = {} # position: attributes
+
+    def append(self, token):
+        if token[0] == STARTTAG:
+            self.start_tags.setdefault(token[1], []).append(len(self))
+            self.all_start_tags.append(len(self))
+        elif token[0] == ENDTAG:
+            self.end_tags.setdefault(token[1], []).append(len(self))
+        super().append(token)
+
+    def attrs(self, i):
+        attrs = self.attr_dicts.get(i)
+        if attrs is None:
+            attrs = self.attr_dicts[i] = dict(self[i][2])
+        return attrs
+
+    def end_of(self, i):
+        # position of the end tag matching the start tag at i, or the end of
+        # the document if it is never closed
+        tag = self[i][1]
+        if tag in VOID_ELEMENTS:
+            if i + 1 < len(self) and self[i+1][0] == ENDTAG and self[i+1][1] == tag:
+                return i + 1
+            return i
+
+        starts = self.start_tags[tag]
+        ends = self.end_tags.get(tag, ())
+        s = bisect.bisect_right(starts, i)
+        e = bisect.bisect_right(ends, i)
+        depth = 0
+        while e < len(ends):
+            if s < len(starts) and starts[s] < ends[e]:
+                depth += 1
+                s += 1
+            elif depth:
+                depth -= 1
+                e += 1
+            else:
+                return ends[e]
+        return len(self)
+
+    def matches(self, i, conditions):
+        attrs = self.attrs(i)
+        for (name, op, value) in conditions:
+            if name not in attrs:
+                return False
+            actual = attrs[name] or ''
+            if op == '=' and actual != value:
+                return False
+            if op == '~=' and value not in actual.split():
+                return False
+            if op == '*=' and value not in actual:
+                return False
+            if op == '^=' and not actual.startswith(value):
+                return False
+            if op == '$=' and not actual.endswith(value):
+                return False
+        return True
+
+    def select(self, selector, start=0, end=None):
+        # positions of the start tags between start and end matching selector,
+        # in document order
+        if end is None:
+            end = len(self)
+
+        result = set()
+        for compounds in parse_selector(selector):
+            ranges = [(start, end)]
+            for n, (tag, conditions) in enumerate(compounds):
+                positions = self.start_tags.get(tag, ()) if tag else self.all_start_tags
+                found = []
+                for (range_start, range_end) in ranges:
+                    for i in positions[bisect.bisect_left(positions, range_start):bisect.bisect_left(positions, range_end)]:
+                        if self.matches(i, conditions):
+                            found.append(i)
+
+                if n + 1 == len(compounds):
+                    result.update(found)
+                    break
+
+                # look inside the elements found, merging the nested ones
+                ranges = []
+                for i in found:
+                    i_end = self.end_of(i)
+                    if ranges and i < ranges[-1][1]:
+                        ranges[-1] = (ranges[-1][0], max(ranges[-1][1], i_end))
+                    else:
+                        ranges.append((i + 1, i_end))
+
+        return sorted(result)
+
+class StdlibTokenizer(html.parser.HTMLParser):
     def __init__(self, convert_charrefs=True, cdata=None, rcdata=None):
-        self.tokens = []
+        self.tokens = TokenDocument()
         if cdata is not None:
             self.CDATA_CONTENT_ELEMENTS = cdata
         if rcdata is not None:
@@ -50,6 +217,91 @@ class HtmlTokenizer(html.parser.HTMLParser):
     def unknown_decl(self, data):
         self.tokens.append((UNKNOWN, data, None))
 
+# the markup libxml2 makes up when it isn't in the document
+_IMPLIED_MARKUP = re.compile(r'<(/?)(html|head|body)[\s/>]|<!(doctype[^<>]*)>', re.IGNORECASE)
+
+class LxmlTokenizer:
+    # produces the same kind of tokens as StdlibTokenizer using libxml2's html
+    # parser. text is only known once the parser has moved past it, so it is
+    # added when the next event comes in.
+    # libxml2 repairs the document as it goes: the html, head and body
+    # elements and the doctype it adds are left out by checking the source
+    # for them, but the end tags it adds for other elements, the stray end
+    # tags and whitespace outside of <html> it drops and the values it gives
+    # valueless attributes are not undone, which is why this is only used
+    # when asked for
+    def __init__(self):
+        self.tokens = TokenDocument()
+        self.parser = lxml.etree.HTMLPullParser(events=('start', 'end', 'comment', 'pi'))
+        self.last = None # (event, element) whose text or tail is still to come
+        self.in_source = set() # 'body', '/body'...
+        self.doctype = None # as written in the source
+        self.source_tail = ''
+        self.implied = set() # elements whose start tag wasn't in the source
+
+    def flush_text(self):
+        if self.last is None:
+            return
+        event, element = self.last
+        self.last = None
+        if event == 'start':
+            text = element.text
+        else:
+            text = element.tail
+            # nothing will look at this element again
+            element.clear(keep_tail=False)
+        if text:
+            self.tokens.append((DATA, text, None))
+
+    def read_events(self):
+        for event, element in self.parser.read_events():
+            self.flush_text()
+            if event == 'comment':
+                self.tokens.append((COMMENT, element.text or '', None))
+                event = 'end'
+            elif event == 'pi':
+                self.tokens.append((PI, f'{element.target} {element.text or ""}?', None))
+                event = 'end'
+            elif event == 'start':
+                if not self.tokens.all_start_tags and not self.implied and self.doctype:
+                    self.tokens.append((DECL, self.doctype, None))
+                if element.tag in ('html', 'head', 'body') and element.tag not in self.in_source:
+                    self.implied.add(element)
+                else:
+                    self.tokens.append((STARTTAG, element.tag, list(element.attrib.items())))
+            elif element.tag in ('html', 'head', 'body') and \
+                (element in self.implied or '/' + element.tag not in self.in_source):
+                pass
+            elif element.tag not in VOID_ELEMENTS:
+                self.tokens.append((ENDTAG, element.tag, False))
+            self.last = (event, element)
+
+    def feed(self, data):
+        # the tail is kept so a tag split between two pieces is still seen
+        source = self.source_tail + data
+        for match in _IMPLIED_MARKUP.finditer(source):
+            if match.group(3) is not None:
+                self.doctype = self.doctype or match.group(3)
+            else:
+                self.in_source.add(match.group(1) + match.group(2).lower())
+        self.source_tail = source[-256:]
+        self.parser.feed(data)
+        self.read_events()
+
+    def close(self):
+        self.parser.close()
+        self.read_events()
+        self.flush_text()
+
+# 'stdlib' or 'lxml', set from --tokenizer
+tokenizer_backend = 'stdlib'
+
+def HtmlTokenizer(convert_charrefs=True, cdata=None, rcdata=None):
+    # lxml only does plain html, anything else needs html.parser
+    if convert_charrefs and cdata is None and rcdata is None and lxml is not None and tokenizer_backend == 'lxml':
+        return LxmlTokenizer()
+    return StdlibTokenizer(convert_charrefs, cdata, rcdata)
+
 def handle_soundcloud(url, js, state, data, data_str, tokens):
     if 'html:meta:property:twitter:app:url:googleplay' in js and \
         js['html:meta:property:twitter:app:url:googleplay'].startswith('soundcloud://users:'):
@@ -63,46 +315,38 @@ def handle_soundcloud(url, js, state, data, data_str, tokens):
 
         found_any = False
 
-        for i in range(len(tokens)):
-            if tokens[i][0] == STARTTAG and tokens[i][1] == 'article' and dict(tokens[i][2]).get('class') == 'audible':
-                entry = {}
-                found_any = True
-                entry['fm:author'] = js['fm:author']
-                j = i + 1
-
-                while not (tokens[j][0] == ENDTAG and tokens[j][1] == 'article'):
-                    if tokens[j][0] == STARTTAG and tokens[j][1] == 'a' and dict(tokens[j][2]).get('itemprop') == 'url':
-                        entry['fm:link'] = urllib.parse.urljoin(url, dict(tokens[j][2])['href'])
-                        j += 1
-                        if tokens[j][0] == DATA:
-                            entry['fm:title'] = tokens[j][1]
-                            j += 1
-                    elif tokens[j][0] == STARTTAG and tokens[j][1] == 'time' and 'pubdate' in dict(tokens[j][2]):
-                        j += 1
-                        if tokens[j][0] == DATA:
-                            entry['fm:timestamp'] = tokens[j][1]
-                            j += 1
-                    elif tokens[j][0] == STARTTAG and tokens[j][1] == 'meta' and dict(tokens[j][2]).get('itemprop') == 'duration':
-                        entry['duration'] = dict(tokens[j][2]).get('content')
-                        j += 1
-                    else:
-                        j += 1
-
-                if prev_mtime and entry['fm:timestamp'] <= prev_mtime:
-                    continue
+        for i in tokens.select('article[class=audible]'):
+            entry = {}
+            found_any = True
+            entry['fm:author'] = js['fm:author']
+
+            for j in tokens.select('a[itemprop=url], time[pubdate], meta[itemprop=duration]', i + 1, tokens.end_of(i)):
+                if tokens[j][1] == 'a':
+                    entry['fm:link'] = urllib.parse.urljoin(url, tokens.attrs(j)['href'])
+                    if tokens[j+1][0] == DATA:
+                        entry['fm:title'] = tokens[j+1][1]
+                elif tokens[j][1] == 'time':
+                    if tokens[j+1][0] == DATA:
+                        entry['fm:timestamp'] = tokens[j+1][1]
+                else:
+                    entry['duration'] = tokens.attrs(j).get('content')
 
-                entry_html_json, entry_tokens = fetch_html(entry['fm:link'])
-                entry.update(entry_html_json)
-                entry['fm:text'] = entry_html_json['html:meta:itemprop:description']
+            if prev_mtime and entry['fm:timestamp'] <= prev_mtime:
+                continue
 
-                if new_mtime is None or new_mtime < entry['fm:timestamp']:
-                    new_mtime = entry['fm:timestamp']
+            if new_mtime is None or new_mtime < entry['fm:timestamp']:
+                new_mtime = entry['fm:timestamp']
 
-                entries.append(entry)
+            entries.append(entry)
 
         if not found_any:
             raise Exception("Didn't find any uploads")
 
+        pages = fetch_html_many([entry['fm:link'] for entry in entries])
+        for entry, (entry_html_json, entry_tokens) in zip(entries, pages):
+            entry.update(entry_html_json)
+            entry['fm:text'] = entry_html_json['html:meta:itemprop:description']
+
         state['soundcloud', url, 'latest_mtime'] = new_mtime or prev_mtime
         return core.JSON, js
 
@@ -126,63 +370,54 @@ def handle_soundgasm(url, js, state, data, data_str, tokens):
 
         found_any = False
 
-        for i in range(len(tokens)):
-            if tokens[i][0] == STARTTAG and tokens[i][1] == 'div' and dict(tokens[i][2]).get('class') == 'sound-details':
-                entry = {}
-                found_any = True
-                entry['fm:author'] = js['fm:author']
-                j = i + 1
+        for i in tokens.select('div[class=sound-details]'):
+            entry = {}
+            found_any = True
+            entry['fm:author'] = js['fm:author']
+            j = i + 1
 
-                # parse html data
-                assert tokens[j][0] == STARTTAG and tokens[j][1] == 'a'
-                entry['fm:link'] = urllib.parse.urljoin(url, dict(tokens[j][2])['href'])
-                j += 1
+            # parse html data
+            assert tokens[j][0] == STARTTAG and tokens[j][1] == 'a'
+            entry['fm:link'] = urllib.parse.urljoin(url, tokens.attrs(j)['href'])
+            j += 1
 
-                if entry['fm:link'] == prev_url:
-                    break
+            if entry['fm:link'] == prev_url:
+                break
 
-                new_url = entry['fm:link']
-
-                assert tokens[j][0] == DATA and tokens[j][1].strip()
-                entry['fm:title'] = tokens[j][1]
-                j += 1
-
-                while not (tokens[j][0] == ENDTAG and tokens[j][1] == 'div'):
-                    if tokens[j][0] == STARTTAG and tokens[j][1] == 'span' and dict(tokens[j][2]).get('class') == 'soundDescription':
-                        j += 1
-                        if tokens[j][0] == DATA:
-                            if tokens[j][1].strip():
-                                entry['fm:text'] = tokens[j][1]
-                            j += 1
-                    elif tokens[j][0] == STARTTAG and tokens[j][1] == 'span' and dict(tokens[j][2]).get('class') == 'playCount':
-                        j += 1
-
-                        assert tokens[j][0] == DATA and tokens[j][1].strip()
-                        entry['play_count'] = int(tokens[j][1].rsplit(' ', 1)[-1])
-                        j += 1
-                    else:
-                        j += 1
+            new_url = entry['fm:link']
 
-                entry_html = urllib.request.urlopen(entry['fm:link']).read().decode('utf-8')
+            assert tokens[j][0] == DATA and tokens[j][1].strip()
+            entry['fm:title'] = tokens[j][1]
+            j += 1
 
-                entry['media_url'] = entry_html.split('            m4a: "', 1)[1].split('"', 1)[0]
+            for j in tokens.select('span[class=soundDescription], span[class=playCount]', j, tokens.end_of(i)):
+                if tokens.attrs(j)['class'] == 'soundDescription':
+                    if tokens[j+1][0] == DATA and tokens[j+1][1].strip():
+                        entry['fm:text'] = tokens[j+1][1]
+                else:
+                    assert tokens[j+1][0] == DATA and tokens[j+1][1].strip()
+                    entry['play_count'] = int(tokens[j+1][1].rsplit(' ', 1)[-1])
 
-                req = urllib.request.Request(entry['media_url'], method='HEAD', headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:127.0) Gecko/20100101 Firefox/127.0',
-                })
-                html_mtime = urllib.request.urlopen(req).headers['Last-Modified']
-                entry['fm:timestamp'] = email.utils.parsedate_to_datetime(html_mtime).isoformat()
+            entry_html = fm_http.urlopen(entry['fm:link']).read().decode('utf-8')
 
-                if prev_mtime and entry['fm:timestamp'] <= prev_mtime:
-                    break
+            entry['media_url'] = entry_html.split('            m4a: "', 1)[1].split('"', 1)[0]
 
-                if new_mtime is None:
-                    new_mtime = entry['fm:timestamp']
+            req = urllib.request.Request(entry['media_url'], method='HEAD', headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:127.0) Gecko/20100101 Firefox/127.0',
+            })
+            html_mtime = fm_http.urlopen(req).headers['Last-Modified']
+            entry['fm:timestamp'] = email.utils.parsedate_to_datetime(html_mtime).isoformat()
 
-                entries.append(entry)
+            if prev_mtime and entry['fm:timestamp'] <= prev_mtime:
+                break
+
+            if new_mtime is None:
+                new_mtime = entry['fm:timestamp']
+
+            entries.append(entry)
         
-                if not prev_mtime:
-                    break
+            if not prev_mtime:
+                break
 
         if not found_any:
             raise Exception("Didn't find any uploads")
@@ -199,22 +434,21 @@ def handle_ondisneyplus(url, js, state, data, data_str, tokens):
 
     prev_slugs = set(state.get(('ondisneyplus', url, 'slugs'), []))
 
-    for i in range(len(tokens)):
-        if tokens[i][0] == STARTTAG:
-            attrs = dict(tokens[i][2])
-            if tokens[i][1] == 'div' and 'building-block' in attrs.get('class', '').split():
-                if current_entry:
-                    entries.append(current_entry)
-                    current_entry = {}
-            elif tokens[i][1] == 'a' and 'data-anchor-name' in attrs:
-                current_entry['fm:link'] = urllib.parse.urljoin(url, attrs['href'])
-                current_entry['data-slug'] = attrs['data-slug']
-                current_entry['data-anchor-name'] = attrs['data-anchor-name']
-            elif tokens[i][1] == 'img' and 'thumb' in attrs.get('class', '').split() and 'data-src' in attrs:
-                current_entry['fm:thumbnail'] = urllib.parse.urljoin(url, attrs['data-src'])
-                current_entry['fm:title'] = attrs['alt']
-            elif tokens[i][1] == 'p' and attrs.get('class') == 'desc' and tokens[i+1][0] == DATA:
-                current_entry['fm:text'] = tokens[i+1][1]
+    for i in tokens.select('div.building-block, a[data-anchor-name], img.thumb[data-src], p[class=desc]'):
+        attrs = tokens.attrs(i)
+        if tokens[i][1] == 'div':
+            if current_entry:
+                entries.append(current_entry)
+                current_entry = {}
+        elif tokens[i][1] == 'a':
+            current_entry['fm:link'] = urllib.parse.urljoin(url, attrs['href'])
+            current_entry['data-slug'] = attrs['data-slug']
+            current_entry['data-anchor-name'] = attrs['data-anchor-name']
+        elif tokens[i][1] == 'img':
+            current_entry['fm:thumbnail'] = urllib.parse.urljoin(url, attrs['data-src'])
+            current_entry['fm:title'] = attrs['alt']
+        elif tokens[i+1][0] == DATA:
+            current_entry['fm:text'] = tokens[i+1][1]
 
     if current_entry:
         entries.append(current_entry)
@@ -250,9 +484,8 @@ def handle_mcstories(url, js, state, data, data_str, tokens):
 
         found_any = False
 
-        for i in range(len(tokens)):
-            if tokens[i][0] == STARTTAG and tokens[i][1] == 'tr' and \
-                tokens[i+1][0] == STARTTAG and tokens[i+1][1] == 'td':
+        for i in tokens.start_tags.get('tr', ()):
+            if tokens[i+1][0] == STARTTAG and tokens[i+1][1] == 'td':
                 entry = {}
                 found_any = True
                 entry['fm:author'] = js['fm:author']
@@ -263,7 +496,7 @@ def handle_mcstories(url, js, state, data, data_str, tokens):
                     if tokens[j][0] == STARTTAG and tokens[j][1] == 'td':
                         td += 1
                     elif tokens[j][0] == STARTTAG and tokens[j][1] == 'a':
-                        entry['fm:link'] = urllib.parse.urljoin(url, dict(tokens[j][2])['href'])
+                        entry['fm:link'] = urllib.parse.urljoin(url, tokens.attrs(j)['href'])
                     elif tokens[j][0] == STARTTAG and tokens[j][1] == 'cite':
                         in_cite = True
                     elif tokens[j][0] == DATA and tokens[j][1].strip():
@@ -289,16 +522,17 @@ def handle_mcstories(url, js, state, data, data_str, tokens):
 
                 entry['fm:timestamp'] = entry_ts
 
-                if prev_latest:
-                    entry_html_json, entry_tokens = fetch_html(entry['fm:link'])
-                    entry['fm:timestamp'] = entry_html_json['http:mtime_iso']
-                    entry['fm:text'] = entry_html_json['html:meta:name:dcterms.description']
-
                 entries.append(entry)
 
         if not found_any:
             raise Exception("Didn't find any stories")
 
+        if prev_latest:
+            pages = fetch_html_many([entry['fm:link'] for entry in entries])
+            for entry, (entry_html_json, entry_tokens) in zip(entries, pages):
+                entry['fm:timestamp'] = entry_html_json['http:mtime_iso']
+                entry['fm:text'] = entry_html_json['html:meta:name:dcterms.description']
+
         state['mcstories', url, 'latest'] = new_latest or prev_latest
         return core.JSON, js
 
@@ -336,31 +570,35 @@ def find_host_handler(url, host_handlers):
         if not isinstance(host_handlers, dict):
             return host_handlers
 
-def handle_html(url, js, state, data, data_str, tokens, use_handlers=True):
-    old_charset = js.get('http:charset', 'utf-8')
+def html_meta(data, data_str, tokens, charset):
+    # returns the html:* fields of a page, along with the charset, data_str
+    # and tokens, which change if the page declares another charset
+    old_charset = charset_name(charset)
 
     # look for a charset declaration
     html_charset = None
-    for i in range(len(tokens)):
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'meta':
-            attrs = dict(tokens[i][2])
-            if 'charset' in attrs:
-                html_charset = attrs['charset']
-                break
-            if 'http-equiv' in attrs and attrs.get('http-equiv').lower() == 'content-type' and \
-                'content' in attrs and 'charset=' in attrs['content'].lower():
-                html_charset = attrs['content'].lower().split('charset=', 1)[1].split(';', 1)[0]
-                break
+    for i in tokens.start_tags.get('meta', ()):
+        attrs = tokens.attrs(i)
+        if 'charset' in attrs:
+            html_charset = attrs['charset']
+            break
+        if 'http-equiv' in attrs and attrs.get('http-equiv').lower() == 'content-type' and \
+            'content' in attrs and 'charset=' in attrs['content'].lower():
+            html_charset = attrs['content'].lower().split('charset=', 1)[1].split(';', 1)[0]
+            break
 
-    if html_charset and html_charset != old_charset:
+    # only when the declaration was too far in for sniff_charset to see it
+    if html_charset and charset_name(html_charset) and charset_name(html_charset) != old_charset:
+        charset = html_charset
         data_str = data.decode(html_charset, errors='replace')
         parser = HtmlTokenizer()
         parser.feed(data_str)
         tokens = parser.tokens
 
-    for i in range(len(tokens)):
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'meta':
-            attrs = dict(tokens[i][2])
+    js = {}
+    for i in tokens.select('meta, title'):
+        if tokens[i][1] == 'meta':
+            attrs = tokens.attrs(i)
             if 'name' in attrs and 'content' in attrs:
                 js[f'html:meta:name:{attrs["name"].lower()}'] = attrs['content']
             elif 'http-equiv' in attrs and 'content' in attrs:
@@ -371,13 +609,20 @@ def handle_html(url, js, state, data, data_str, tokens, use_handlers=True):
                 js[f'html:meta:itemprop:{attrs["itemprop"].lower()}'] = attrs['content']
             elif 'property' in attrs and 'content' in attrs:
                 js[f'html:meta:property:{attrs["property"].lower()}'] = attrs['content']
-        elif tokens[i][0] == STARTTAG and tokens[i][1] == 'title':
+        else:
             try:
                 if tokens[i+1][0] == DATA:
                     js['html:title'] = tokens[i+1][1]
             except IndexError:
                 pass
 
+    return js, charset, data_str, tokens
+
+def handle_html(url, js, state, data, data_str, tokens, use_handlers=True, charset=None):
+    # charset is what data was decoded with, usually from sniff_charset
+    meta, _charset, data_str, tokens = html_meta(data, data_str, tokens, charset or js.get('http:charset', 'utf-8'))
+    js.update(meta)
+
     if use_handlers:
         host_handler = find_host_handler(url, html_host_handlers)
         if host_handler:
@@ -385,7 +630,9 @@ def handle_html(url, js, state, data, data_str, tokens, use_handlers=True):
             if result[0] != core.UNHANDLED:
                 return result
 
-    # defaults:
+    return html_defaults(js, data_str)
+
+def html_defaults(js, data_str):
     entry = {}
     js['fm:entries'] = [entry]
 
@@ -437,60 +684,84 @@ def handle_mrss(entry):
 
 favicon_cache = {}
 
-def find_favicon(url):
-    if url in favicon_cache:
-        return favicon_cache[url]
-
-    best_link = None
-    best_size = -1
-    try:
-        tokens = get_page_tokens(url)
-    except urllib.error.HTTPError:
-        pass
-    except urllib.error.URLError:
-        pass
-    else:
-        for token in tokens:
-            if token[0] == STARTTAG and token[1] == 'link':
-                attrs = dict(token[2])
-                if attrs.get('rel') in ("icon", "shortcut icon", "apple-touch-icon") and 'href' in attrs:
-                    if 'sizes' in attrs:
-                        if attrs['sizes'] == 'any':
-                            this_size = "any"
+def find_favicon(url, state=None):
+    # the best icon declared in the head of url, pages can have their own
+    # (tumblr puts the user's avatar there) so this is kept per page
+    with core.lock('favicon', url):
+        if url in favicon_cache:
+            return favicon_cache[url]
+
+        found, best_link = core.get_expiring(state, ('favicon', url, 'html'), core.FAVICON_TTL, core.FAVICON_MISS_TTL)
+        if found:
+            favicon_cache[url] = best_link
+            return best_link
+
+        best_link = None
+        best_size = -1
+        try:
+            # icons are declared in the head, so stop there
+            tokens = get_page_tokens(url, end_of_head)
+        except urllib.error.HTTPError:
+            pass
+        except urllib.error.URLError:
+            pass
+        else:
+            for i in tokens.select('link, meta'):
+                attrs = tokens.attrs(i)
+                if tokens[i][1] == 'link':
+                    if attrs.get('rel') in ("icon", "shortcut icon", "apple-touch-icon") and 'href' in attrs:
+                        if 'sizes' in attrs:
+                            if attrs['sizes'] == 'any':
+                                this_size = "any"
+                            else:
+                                this_size = int(attrs['sizes'].split('x')[0])
+                        elif attrs['rel'] == 'apple-touch-icon':
+                            this_size = 192
                         else:
-                            this_size = int(attrs['sizes'].split('x')[0])
-                    elif attrs['rel'] == 'apple-touch-icon':
-                        this_size = 192
-                    else:
-                        this_size = 16
-                    if this_size != "any" and this_size > best_size:
-                        best_size = this_size
-                        best_link = urllib.parse.urljoin(url, attrs['href'])
-            if token[0] == STARTTAG and token[1] == 'meta':
-                attrs = dict(token[2])
-                if attrs.get('name') == 'parsely-image-url':
+                            this_size = 16
+                        if this_size != "any" and this_size > best_size:
+                            best_size = this_size
+                            best_link = urllib.parse.urljoin(url, attrs['href'])
+                elif attrs.get('name') == 'parsely-image-url':
                     # tumblr uses this for the user avatar, so prefer it
                     best_link = urllib.parse.urljoin(url, attrs['content'])
                     break
 
-    favicon_cache[url] = best_link
+        favicon_cache[url] = best_link
+        core.set_expiring(state, ('favicon', url, 'html'), best_link)
+
+        return best_link # may be None
 
-    return best_link # may be None
+def origin_favicon(url, state=None):
+    # the icon for the whole site url is on: what find_favicon found on its
+    # front page, when it has looked there, or else /favicon.ico if it exists
+    origin = urllib.parse.urljoin(url, '/')
+    found, favicon = core.get_expiring(state, ('favicon', origin, 'html'), core.FAVICON_TTL, core.FAVICON_MISS_TTL)
+    if found and favicon:
+        return favicon
 
-def get_author_info(url, author_name, is_author_link=False):
+    with core.lock('favicon', origin, 'ico'):
+        found, favicon = core.get_expiring(state, ('favicon', origin, 'ico'), core.FAVICON_TTL, core.FAVICON_MISS_TTL)
+        if not found:
+            favicon = urllib.parse.urljoin(origin, '/favicon.ico')
+            try:
+                fm_http.urlopen(urllib.request.Request(favicon, method='HEAD'))
+            except:
+                favicon = None
+            core.set_expiring(state, ('favicon', origin, 'ico'), favicon)
+
+    return favicon
+
+def get_author_info(url, tokens, author_name, is_author_link=False):
     result = {}
-    try:
-        tokens = get_page_tokens(url)
-    except urllib.error.URLError:
-        return result
     if is_author_link:
         classes = ('author', 'headshot', 'head_shot', 'contributor', 'avatar')
     else:
         classes = ('author', 'headshot', 'head_shot')
-    for i in range(len(tokens)):
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'a':
+    for i in tokens.select('a, img, script, meta'):
+        if tokens[i][1] == 'a':
             num_indicators = 0
-            attrs = dict(tokens[i][2])
+            attrs = tokens.attrs(i)
             if attrs.get('href'):
                 img_link = None
                 if any(c in attrs['href'].lower() for c in classes):
@@ -502,7 +773,7 @@ def get_author_info(url, author_name, is_author_link=False):
                 if author_name.lower() in urllib.parse.unquote(attrs['href']).lower().replace('-', ' ').replace('_', ' ').replace('%20', ' '):
                     num_indicators += 1
                 if i + 1 < len(tokens) and tokens[i+1][0] == STARTTAG and tokens[i+1][1] == 'img':
-                    img_attrs = dict(tokens[i+1][2])
+                    img_attrs = tokens.attrs(i+1)
                     if 'class' in img_attrs and any(c in img_attrs['class'].lower() for c in classes):
                         num_indicators += 1
                     if 'src' in img_attrs:
@@ -516,8 +787,8 @@ def get_author_info(url, author_name, is_author_link=False):
                     if img_link:
                         result['fm:avatar'] = img_link
                         break
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'img':
-            attrs = dict(tokens[i][2])
+        if tokens[i][1] == 'img':
+            attrs = tokens.attrs(i)
             link = None
             if 'src' in attrs:
                 link = urllib.parse.urljoin(url, attrs['src'])
@@ -539,62 +810,91 @@ def get_author_info(url, author_name, is_author_link=False):
                 if num_indicators >= 2:
                     result['fm:avatar'] = link
                     break
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'script' and tokens[i+1][0] == DATA and tokens[i+1][1].startswith('var initialData = ') and is_author_link:
+        if tokens[i][1] == 'script' and tokens[i+1][0] == DATA and tokens[i+1][1].startswith('var initialData = ') and is_author_link:
             ytdata = json.loads(tokens[i+1][1][18:-1])
             result['fm:avatar'] = ytdata['header']['pageHeaderRenderer']['content']['pageHeaderViewModel']['image']['decoratedAvatarViewModel']['avatar']['avatarViewModel']['image']['sources'][-1]['url']
             break
-        if tokens[i][0] == STARTTAG and tokens[i][1] == 'meta':
-            attrs = dict(tokens[i][2])
+        if tokens[i][1] == 'meta':
+            attrs = tokens.attrs(i)
             if attrs.get('property') == 'og:image' and attrs.get('content') and is_author_link:
                 result['fm:avatar'] = urllib.parse.urljoin(url, attrs['content'])
 
     return result
 
-def find_avatars(js):
-    authors = {}
-    author_links = {}
-
-    for entry in js.get('fm:entries', ()):
-        if 'fm:avatar' not in entry:
-            if 'fm:author' in entry and 'fm:link' in entry:
-                author = entry['fm:author']
-                if author in authors:
-                    if authors[author]:
-                        entry['fm:avatar'] = authors[author]
-                    if author_links.get(author):
-                        entry['fm:author_link'] = author_links[author]
-                    continue
+# how many pages find_avatars fetches at once
+AUTHOR_PROBE_JOBS = 8
 
-                if 'fm:author_link' not in entry and author.startswith(('http://', 'https://')):
-                    entry['fm:author_link'] = author
-
-                if 'fm:author_link' not in entry:
-                    info = get_author_info(entry['fm:link'], author)
-                    for key in info:
-                        if key not in entry:    
-                            entry[key] = info[key]
-
-                    if 'fm:author_link' in info:
-                        author_links[author] = info['fm:author_link']
+def get_page_tokens_many(urls, jobs=AUTHOR_PROBE_JOBS):
+    # fetches pages concurrently, returns {url: tokens} for the ones that
+    # could be fetched
+    urls = list(dict.fromkeys(urls))
+    result = {}
+    if not urls:
+        return result
+    with concurrent.futures.ThreadPoolExecutor(min(jobs, len(urls))) as pool:
+        futures = {url: pool.submit(get_page_tokens, url) for url in urls}
+        for url, future in futures.items():
+            try:
+                result[url] = future.result()
+            except urllib.error.URLError:
+                pass
+    return result
 
-                    if 'fm:avatar' in info:
-                        authors[author] = info['fm:avatar']
-                        continue
+def find_avatars(js, state=None):
+    # what was found for an author is remembered per site across runs, and
+    # pages for the authors that aren't known yet are fetched concurrently
+    authors = {} # author: {'fm:author_link': ..., 'fm:avatar': ...}
+    lookups = {} # author: (origin, first entry by them)
 
-                if 'fm:author_link' in entry:
-                    # search page for author avatar
-                    info = get_author_info(entry['fm:author_link'], author, is_author_link=True)
-                    for key in info:
-                        if key not in entry:    
-                            entry[key] = info[key]
+    for entry in js.get('fm:entries', ()):
+        if 'fm:avatar' in entry or 'fm:author' not in entry or 'fm:link' not in entry:
+            continue
+        author = entry['fm:author']
+        if author in authors or author in lookups:
+            continue
+        origin = urllib.parse.urljoin(entry['fm:link'], '/')
+        found, info = core.get_expiring(state, ('author', origin, author), core.AUTHOR_TTL, core.AUTHOR_MISS_TTL)
+        if found:
+            authors[author] = info or {}
+        else:
+            lookups[author] = (origin, entry)
+
+    for author, (origin, entry) in lookups.items():
+        authors[author] = {}
+        if 'fm:author_link' not in entry and author.startswith(('http://', 'https://')):
+            authors[author]['fm:author_link'] = author
+
+    def author_link(author):
+        return lookups[author][1].get('fm:author_link') or authors[author].get('fm:author_link')
+
+    # search the entry's page for a link to the author
+    pending = {author: lookups[author][1]['fm:link'] for author in lookups if not author_link(author)}
+    pages = get_page_tokens_many(pending.values())
+    for author, url in pending.items():
+        if url in pages:
+            authors[author].update(get_author_info(url, pages[url], author))
+
+    # search the author's page for their avatar
+    pending = {author: author_link(author) for author in lookups
+        if author_link(author) and 'fm:avatar' not in authors[author]}
+    pages = get_page_tokens_many(pending.values())
+    for author, url in pending.items():
+        if url in pages:
+            for key, value in get_author_info(url, pages[url], author, is_author_link=True).items():
+                authors[author].setdefault(key, value)
+
+    for author, (origin, entry) in lookups.items():
+        core.set_expiring(state, ('author', origin, author), authors[author] or None)
 
-                    if 'fm:avatar' in info:
-                        authors[author] = info['fm:avatar']
-                        continue
+    for entry in js.get('fm:entries', ()):
+        if 'fm:avatar' not in entry and entry.get('fm:author') in authors and 'fm:link' in entry:
+            for key, value in authors[entry['fm:author']].items():
+                if key not in entry:
+                    entry[key] = value
 
     if any('fm:avatar' not in x for x in js.get('fm:entries', ())) and js.get('fm:link'):
         if not js.get('fm:avatar'):
-            favicon = find_favicon(js['fm:link'])
+            favicon = find_favicon(js['fm:link'], state)
             if favicon:
                 js['fm:avatar'] = favicon
         if js.get('fm:avatar'):
@@ -602,141 +902,27 @@ def find_avatars(js):
                 if 'fm:avatar' not in entry:
                     entry['fm:avatar'] = js['fm:avatar']
 
-def handle_rss(url, js, state, data, data_str, tokens):
-    prev_latest = state.get(('rss', url, 'latest'))
-
-    new_latest = None
-
-    # Re-parse without special handling of <title> for HTML
-    parser = HtmlTokenizer(cdata=[], rcdata=[])
-    parser.feed(data_str)
-    tokens = parser.tokens
-
-    stack = [('', js)] # tagname, dictionary
-
-    # split this into dictionaries
-    for (token_type, token_name, token_data) in tokens:
-        if token_type == STARTTAG and token_name in ('rss', 'channel'):
-            # ignore these tags
-            continue
-
-        if token_type == STARTTAG and token_name == 'item':
-            entry = {}
-            stack.append(('item', entry))
-            if 'fm:entries' not in js:
-                js['fm:entries'] = []
-            js['fm:entries'].append(entry)
-            continue
-
-        if token_type == STARTTAG:
-            stack.append((token_name, {key: value for key, value in token_data if not key.startswith('xmlns:')}))
-            continue
-
-        if token_type == DATA and token_name.strip():
-            stack[-1][1]['inner'] = token_name
-            continue
-
-        if token_type == UNKNOWN and token_name.startswith('CDATA['):
-            stack[-1][1]['inner'] = token_name[6:]
-            continue
-
-        if token_type == ENDTAG and any(x[0] == token_name for x in stack):
-            while True:
-                old_tag, old_dict = stack.pop()
-
-                if old_tag != 'item':
-                    if len(old_dict) == 1 and 'inner' in old_dict:
-                        val = old_dict['inner']
-                    else:
-                        val = old_dict
-
-                    parent_dict = stack[-1][1]
-
-                    if old_tag in parent_dict:
-                        if isinstance(parent_dict[old_tag], list):
-                            parent_dict[old_tag].append(val)
-                        else:
-                            parent_dict[old_tag] = [parent_dict[old_tag], val]
-                    else:
-                        parent_dict[old_tag] = val
-
-                if old_tag == token_name:
-                    break
-            continue
-
-    if 'title' in js:
-        js['fm:title'] = html.unescape(js['title'])
-
-    if 'link' in js:
-        js['fm:link'] = js['link']
-
-    if 'icon' in js:
-        js['fm:avatar'] = js['icon']
-
-    for entry in js['fm:entries']:
-        if 'link' in entry:
-            entry['fm:link'] = entry['link']
-        elif 'enclosure' in entry and 'url' in entry['enclosure']:
-            entry['fm:link'] = entry['enclosure']['url']
-        if 'title' in entry:
-            entry['fm:title'] = html.unescape(entry['title'])
-        if 'content:encoded' in entry:
-            entry['fm:html'] = entry['content:encoded']
-        elif 'description' in entry:
-            entry['fm:html'] = entry['description']
-        if 'author' in entry:
-            entry['fm:author'] = entry['author']
-        elif 'dc:creator' in entry:
-            if isinstance(entry['dc:creator'], list):
-                entry['fm:author'] = ', '.join(entry['dc:creator'])
-            else:
-                entry['fm:author'] = entry['dc:creator']
-        if 'pubdate' in entry:
-            entry['fm:timestamp'] = email.utils.parsedate_to_datetime(entry['pubdate']).isoformat()
-        if 'icon' in entry:
-            entry['fm:avatar'] = entry['icon']
-        handle_mrss(entry)
-
-    for i in range(len(js['fm:entries']) - 1, -1, -1):
-        entry = js['fm:entries'][i]
-        if 'fm:timestamp' in entry:
-            ts = entry['fm:timestamp']
-            if prev_latest and ts <= prev_latest:
-                js['fm:entries'].pop(i)
-                continue
-            if not new_latest or ts > new_latest:
-                new_latest = ts
-
-    state['rss', url, 'latest'] = new_latest or prev_latest
-
-    find_avatars(js)
-
-    return core.JSON, js
-
-def handle_atom(url, js, state, data, data_str, tokens):
-    prev_latest = state.get(('atom', url, 'latest'))
-
-    new_latest = None
-
-    stack = [('', js)] # tagname, dictionary
+def _add_child(parent_dict, tag, val):
+    if tag in parent_dict:
+        if isinstance(parent_dict[tag], list):
+            parent_dict[tag].append(val)
+        else:
+            parent_dict[tag] = [parent_dict[tag], val]
+    else:
+        parent_dict[tag] = val
 
-    # Re-parse without special handling of <title> for HTML
-    parser = HtmlTokenizer(cdata=[], rcdata=[])
-    parser.feed(data_str)
-    tokens = parser.tokens
+def feed_dicts_from_tokens(tokens, root, ignored, entry_tag, on_entry, xhtml=False):
+    # the forgiving version of FeedParser, for feeds that aren't well formed
+    stack = [('', root)] # tagname, dictionary
 
     # split this into dictionaries
     for (token_type, token_name, token_data) in tokens:
-        if token_type == STARTTAG and token_name in ('feed', 'channel'):
+        if token_type == STARTTAG and token_name in ignored:
             # ignore these tags
             continue
 
-        if token_type == STARTTAG and token_name == 'entry':
-            entry = {}
-            stack.append(('entry', entry))
-            if 'fm:entries' not in js:
-                js['fm:entries'] = []
-            js['fm:entries'].append(entry)
+        if token_type == STARTTAG and token_name == entry_tag:
+            stack.append((entry_tag, {}))
             continue
 
         if 'fm:_inner_xml' in stack[-1][1]:
@@ -746,16 +932,7 @@ def handle_atom(url, js, state, data, data_str, tokens):
                     old_tag, old_dict = stack.pop()
                     old_dict['inner'] = ''.join(old_dict['fm:_inner_xml'])
                     del old_dict['fm:_inner_xml']
-
-                    parent_dict = stack[-1][1]
-
-                    if old_tag in parent_dict:
-                        if isinstance(parent_dict[old_tag], list):
-                            parent_dict[old_tag].append(old_dict)
-                        else:
-                            parent_dict[old_tag] = [parent_dict[old_tag], old_dict]
-                    else:
-                        parent_dict[old_tag] = old_dict
+                    _add_child(stack[-1][1], old_tag, old_dict)
                 else:
                     inner.append('</')
                     inner.append(token_name)
@@ -778,7 +955,7 @@ def handle_atom(url, js, state, data, data_str, tokens):
 
         if token_type == STARTTAG:
             stack.append((token_name, {key: value for key, value in token_data if not key.startswith('xmlns:')}))
-            if stack[-1][1].get('type') == 'xhtml':
+            if xhtml and stack[-1][1].get('type') == 'xhtml':
                 stack[-1][1]['fm:_inner_xml'] = []
             continue
 
@@ -794,144 +971,499 @@ def handle_atom(url, js, state, data, data_str, tokens):
             while True:
                 old_tag, old_dict = stack.pop()
 
-                if old_tag != 'entry':
+                if old_tag != entry_tag:
                     if len(old_dict) == 1 and 'inner' in old_dict:
                         val = old_dict['inner']
                     else:
                         val = old_dict
-
-                    parent_dict = stack[-1][1]
-
-                    if old_tag in parent_dict:
-                        if isinstance(parent_dict[old_tag], list):
-                            parent_dict[old_tag].append(val)
-                        else:
-                            parent_dict[old_tag] = [parent_dict[old_tag], val]
-                    else:
-                        parent_dict[old_tag] = val
+                    _add_child(stack[-1][1], old_tag, val)
+                else:
+                    on_entry(old_dict)
 
                 if old_tag == token_name:
                     break
             continue
 
-    if js.get('feed'):
-        if 'link' in js:
-            if isinstance(js['link'], list):
-                for item in js['link']:
-                    if item.get('rel', 'alternate') == 'alternate':
-                        js['fm:link'] = item['href']
-            else:
-                js['fm:link'] = js['link']['href']
-        if 'title' in js:
-            if isinstance(js['title'], str):
-                js['fm:title'] = js['title']
-            elif js['title'].get('type', 'text') == 'text':
-                js['fm:title'] = js['title']['inner']
-            elif js['title']['type'] == 'html':
-                js['fm:title'] = html.unescape(js['title']['inner'])
-        if 'author' in js:
-            if js['author'].get('name'):
-                js['fm:author'] = js['author']['name']
-            if js['author'].get('uri'):
-                js['fm:author_link'] = js['author']['uri']
-
-    for entry in js.get('fm:entries', []) + [js]:
-        if 'link' in entry:
-            if isinstance(entry['link'], list):
-                for item in entry['link']:
-                    if item.get('rel', 'alternate') == 'alternate':
-                        entry['fm:link'] = item['href']
-            else:
-                entry['fm:link'] = entry['link']['href']
-        if 'title' in entry:
-            if isinstance(entry['title'], str):
-                entry['fm:title'] = entry['title']
-            elif entry['title'].get('type', 'text') == 'text':
-                entry['fm:title'] = entry['title']['inner']
-            elif entry['title']['type'] == 'html':
-                entry['fm:title'] = html.unescape(entry['title']['inner'])
-        if 'content' in entry or 'summary' in entry:
-            content = entry.get('content', entry.get('summary'))
-            if content.get('type') == 'text':
-                entry['fm:text'] = content.get('inner', '')
-            else:
-                entry['fm:html'] = content.get('inner', '')
-                if 'xml:base' in content and entry is not js:
-                    entry['fm:base'] = content['xml:base']
-        if 'author' in entry:
-            if entry['author'].get('name'):
-                entry['fm:author'] = entry['author']['name']
-            if entry['author'].get('uri'):
-                entry['fm:author_link'] = entry['author']['uri']
-        if 'published' in entry or 'updated' in entry:
-            entry['fm:timestamp'] = datetime.datetime.fromisoformat(entry.get('published', entry.get('updated'))).astimezone(datetime.timezone.utc).isoformat()
-        handle_mrss(entry)
-
-    for i in range(len(js.get('fm:entries', ())) - 1, -1, -1):
-        entry = js['fm:entries'][i]
+    # entries that were never closed
+    for old_tag, old_dict in stack[1:]:
+        if old_tag == entry_tag:
+            on_entry(old_dict)
+
+# namespaces the handlers look for by prefix, mapped to that prefix whatever
+# the feed itself declared
+FEED_NAMESPACES = {
+    'http://purl.org/rss/1.0/modules/content/': 'content',
+    'http://purl.org/dc/elements/1.1/': 'dc',
+    'http://search.yahoo.com/mrss/': 'media',
+}
+
+class FeedParser:
+    # builds the same dictionaries as feed_dicts_from_tokens in a single pass
+    # with expat, calling on_entry with each entry as soon as it is complete
+    def __init__(self, root, ignored, entry_tag, on_entry, xhtml=False):
+        self.ignored = ignored
+        self.entry_tag = entry_tag
+        self.on_entry = on_entry
+        self.xhtml = xhtml
+        self.stack = [('', root)] # tagname, dictionary
+        self.elements = [] # tagname, kind for every open element
+        self.namespaces = [{}] # prefix: uri, '' for the default namespace
+        self.text = []
+
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.handle_start
+        self.parser.EndElementHandler = self.handle_end
+        self.parser.CharacterDataHandler = self.handle_data
+        # like the tokenizer, text is only kept up to the next markup
+        self.parser.StartCdataSectionHandler = self.flush_text
+        self.parser.EndCdataSectionHandler = self.flush_text
+        self.parser.CommentHandler = lambda data: self.flush_text()
+        self.parser.ProcessingInstructionHandler = lambda target, data: self.flush_text()
+
+    def feed(self, data_str):
+        for i in range(0, len(data_str), TOKENIZE_CHUNK_SIZE):
+            self.parser.Parse(data_str[i:i + TOKENIZE_CHUNK_SIZE], False)
+        self.parser.Parse('', True)
+
+    def tag_name(self, name, namespaces):
+        prefix, _, local = name.rpartition(':')
+        uri = namespaces.get(prefix)
+        if uri in FEED_NAMESPACES:
+            name = FEED_NAMESPACES[uri] + ':' + local
+        return name.lower()
+
+    def flush_text(self):
+        if self.text:
+            text = ''.join(self.text)
+            self.text = []
+            if text.strip():
+                self.stack[-1][1]['inner'] = text
+
+    def handle_start(self, name, attrs):
+        self.flush_text()
+
+        namespaces = self.namespaces[-1]
+        for key, value in attrs.items():
+            if key == 'xmlns' or key.startswith('xmlns:'):
+                if namespaces is self.namespaces[-1]:
+                    namespaces = dict(namespaces)
+                namespaces[key[6:]] = value
+        self.namespaces.append(namespaces)
+
+        name = self.tag_name(name, namespaces)
+        attrs = [(key.lower(), value) for key, value in attrs.items()]
+
+        inner = self.stack[-1][1].get('fm:_inner_xml')
+        if inner is not None:
+            inner.append('<')
+            inner.append(name)
+            for (key, value) in attrs:
+                inner.append(' ')
+                inner.append(key)
+                inner.append('="')
+                inner.append(html.escape(value))
+                inner.append('"')
+            inner.append('>')
+            self.elements.append((name, 'inner'))
+            return
+
+        if name in self.ignored:
+            self.elements.append((name, 'ignored'))
+            return
+
+        if name == self.entry_tag:
+            self.stack.append((name, {}))
+            self.elements.append((name, 'entry'))
+            return
+
+        self.stack.append((name, {key: value for key, value in attrs if not key.startswith('xmlns:')}))
+        if self.xhtml and self.stack[-1][1].get('type') == 'xhtml':
+            self.stack[-1][1]['fm:_inner_xml'] = []
+        self.elements.append((name, 'value'))
+
+    def handle_end(self, name):
+        self.flush_text()
+        self.namespaces.pop()
+
+        name, kind = self.elements.pop()
+        if kind == 'ignored':
+            return
+
+        if kind == 'inner':
+            self.stack[-1][1]['fm:_inner_xml'].append(f'</{name}>')
+            return
+
+        old_tag, old_dict = self.stack.pop()
+
+        if kind == 'entry':
+            self.on_entry(old_dict)
+            return
+
+        if 'fm:_inner_xml' in old_dict:
+            old_dict['inner'] = ''.join(old_dict.pop('fm:_inner_xml'))
+            val = old_dict
+        elif len(old_dict) == 1 and 'inner' in old_dict:
+            val = old_dict['inner']
+        else:
+            val = old_dict
+        _add_child(self.stack[-1][1], old_tag, val)
+
+    def handle_data(self, data):
+        inner = self.stack[-1][1].get('fm:_inner_xml')
+        if inner is not None:
+            inner.append(html.escape(data, quote=False))
+        else:
+            self.text.append(data)
+
+def parse_feed(data_str, kind, prev_latest):
+    # normalizes and filters entries while the feed is parsed, so entries
+    # that were already seen are dropped as soon as they are complete.
+    # this only looks at the document so it can run in a parse worker
+    ignored, entry_tag, normalize, normalize_feed, xhtml = feed_formats[kind]
+
+    new_latest = None
+    seen = 0
+    entries = []
+
+    def on_entry(entry):
+        nonlocal new_latest, seen
+        seen += 1
+        normalize(entry)
         if 'fm:timestamp' in entry:
             ts = entry['fm:timestamp']
             if prev_latest and ts <= prev_latest:
-                js['fm:entries'].pop(i)
-                continue
+                return
             if not new_latest or ts > new_latest:
                 new_latest = ts
+        entries.append(entry)
+
+    feed = {}
+    try:
+        FeedParser(feed, ignored, entry_tag, on_entry, xhtml).feed(data_str)
+    except xml.parsers.expat.ExpatError:
+        # not well formed, so fall back to the forgiving tokenizer
+        feed = {}
+        new_latest = None
+        seen = 0
+        entries.clear()
+
+        # Re-parse without special handling of <title> for HTML
+        parser = HtmlTokenizer(cdata=[], rcdata=[])
+        parser.feed(data_str)
+        feed_dicts_from_tokens(parser.tokens, feed, ignored, entry_tag, on_entry, xhtml)
+
+    if seen:
+        feed['fm:entries'] = entries
 
-    state['atom', url, 'latest'] = new_latest or prev_latest
+    normalize_feed(feed)
 
-    find_avatars(js)
+    return feed, new_latest
+
+def finish_feed(url, js, state, kind, feed, new_latest):
+    js.update(feed)
+
+    prev_latest = state.get((kind, url, 'latest'))
+    state[kind, url, 'latest'] = new_latest or prev_latest
+
+    find_avatars(js, state)
 
     return core.JSON, js
 
-def get_page_tokens(url):
+def normalize_rss_entry(entry):
+    if 'link' in entry:
+        entry['fm:link'] = entry['link']
+    elif 'enclosure' in entry and 'url' in entry['enclosure']:
+        entry['fm:link'] = entry['enclosure']['url']
+    if 'title' in entry:
+        entry['fm:title'] = html.unescape(entry['title'])
+    if 'content:encoded' in entry:
+        entry['fm:html'] = entry['content:encoded']
+    elif 'description' in entry:
+        entry['fm:html'] = entry['description']
+    if 'author' in entry:
+        entry['fm:author'] = entry['author']
+    elif 'dc:creator' in entry:
+        if isinstance(entry['dc:creator'], list):
+            entry['fm:author'] = ', '.join(entry['dc:creator'])
+        else:
+            entry['fm:author'] = entry['dc:creator']
+    if 'pubdate' in entry:
+        entry['fm:timestamp'] = email.utils.parsedate_to_datetime(entry['pubdate']).isoformat()
+    if 'icon' in entry:
+        entry['fm:avatar'] = entry['icon']
+    handle_mrss(entry)
+
+def normalize_rss_feed(feed):
+    if 'title' in feed:
+        feed['fm:title'] = html.unescape(feed['title'])
+
+    if 'link' in feed:
+        feed['fm:link'] = feed['link']
+
+    if 'icon' in feed:
+        feed['fm:avatar'] = feed['icon']
+
+def handle_rss(url, js, state, data, data_str, tokens):
+    feed, new_latest = parse_feed(data_str, 'rss', state.get(('rss', url, 'latest')))
+    return finish_feed(url, js, state, 'rss', feed, new_latest)
+
+def normalize_atom_entry(entry, is_feed=False):
+    if 'link' in entry:
+        if isinstance(entry['link'], list):
+            for item in entry['link']:
+                if item.get('rel', 'alternate') == 'alternate':
+                    entry['fm:link'] = item['href']
+        else:
+            entry['fm:link'] = entry['link']['href']
+    if 'title' in entry:
+        if isinstance(entry['title'], str):
+            entry['fm:title'] = entry['title']
+        elif entry['title'].get('type', 'text') == 'text':
+            entry['fm:title'] = entry['title']['inner']
+        elif entry['title']['type'] == 'html':
+            entry['fm:title'] = html.unescape(entry['title']['inner'])
+    if 'content' in entry or 'summary' in entry:
+        content = entry.get('content', entry.get('summary'))
+        if content.get('type') == 'text':
+            entry['fm:text'] = content.get('inner', '')
+        else:
+            entry['fm:html'] = content.get('inner', '')
+            if 'xml:base' in content and not is_feed:
+                entry['fm:base'] = content['xml:base']
+    if 'author' in entry:
+        if entry['author'].get('name'):
+            entry['fm:author'] = entry['author']['name']
+        if entry['author'].get('uri'):
+            entry['fm:author_link'] = entry['author']['uri']
+    if 'published' in entry or 'updated' in entry:
+        entry['fm:timestamp'] = datetime.datetime.fromisoformat(entry.get('published', entry.get('updated'))).astimezone(datetime.timezone.utc).isoformat()
+    handle_mrss(entry)
+
+def normalize_atom_feed(feed):
+    if feed.get('feed'):
+        if 'link' in feed:
+            if isinstance(feed['link'], list):
+                for item in feed['link']:
+                    if item.get('rel', 'alternate') == 'alternate':
+                        feed['fm:link'] = item['href']
+            else:
+                feed['fm:link'] = feed['link']['href']
+        if 'title' in feed:
+            if isinstance(feed['title'], str):
+                feed['fm:title'] = feed['title']
+            elif feed['title'].get('type', 'text') == 'text':
+                feed['fm:title'] = feed['title']['inner']
+            elif feed['title']['type'] == 'html':
+                feed['fm:title'] = html.unescape(feed['title']['inner'])
+        if 'author' in feed:
+            if feed['author'].get('name'):
+                feed['fm:author'] = feed['author']['name']
+            if feed['author'].get('uri'):
+                feed['fm:author_link'] = feed['author']['uri']
+
+    normalize_atom_entry(feed, is_feed=True)
+
+def handle_atom(url, js, state, data, data_str, tokens):
+    feed, new_latest = parse_feed(data_str, 'atom', state.get(('atom', url, 'latest')))
+    return finish_feed(url, js, state, 'atom', feed, new_latest)
+
+# kind: (ignored tags, entry tag, entry normalizer, feed normalizer, xhtml content)
+feed_formats = {
+    'rss': (('rss', 'channel'), 'item', normalize_rss_entry, normalize_rss_feed, False),
+    'atom': (('feed', 'channel'), 'entry', normalize_atom_entry, normalize_atom_feed, True),
+}
+
+TOKENIZE_CHUNK_SIZE = 16384
+
+# how far into the document to look for a declared charset
+CHARSET_SNIFF_SIZE = 8192
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+_META_CHARSET = re.compile(rb'''<meta[^>]*?charset\s*=\s*["']?\s*([-\w.:]+)''', re.IGNORECASE)
+_XML_ENCODING = re.compile(rb'''^\s*<\?xml[^>]*?encoding\s*=\s*["']([-\w.:]+)''')
+
+def charset_name(charset):
+    # the python codec name for a charset, or None if there isn't one
+    try:
+        name = codecs.lookup(charset.strip()).name
+    except (LookupError, AttributeError):
+        return None
+    if name.startswith(('utf-16', 'utf-32')):
+        # a document that can declare this in ascii isn't actually in it
+        return 'utf-8'
+    return name
+
+def sniff_charset(data, header_charset=None):
+    # picks the charset to decode a document with before tokenizing it, a BOM
+    # wins, then a charset declared in the document, then the HTTP header
+    for bom, charset in _BOMS:
+        if data.startswith(bom):
+            return charset
+
+    start = data[:CHARSET_SNIFF_SIZE]
+    match = _XML_ENCODING.match(start) or _META_CHARSET.search(start)
+    if match:
+        charset = charset_name(match.group(1).decode('ascii'))
+        if charset:
+            return charset
+
+    if header_charset:
+        charset = charset_name(header_charset)
+        if charset:
+            return charset
+
+    return 'utf-8'
+
+def tokenize(data_str, until):
+    # feeds data_str to the tokenizer a piece at a time and stops as soon as
+    # until(tokens, start) is true for the tokens from start onwards, so the
+    # last tokens may be incomplete
+    parser = HtmlTokenizer()
+    checked = 0
+    for pos in range(0, len(data_str), TOKENIZE_CHUNK_SIZE):
+        parser.feed(data_str[pos:pos+TOKENIZE_CHUNK_SIZE])
+        if until(parser.tokens, checked):
+            break
+        checked = len(parser.tokens)
+    return parser.tokens
+
+def end_of_head(tokens, start):
+    for token in tokens[start:]:
+        if (token[0] == STARTTAG and token[1] == 'body') or (token[0] == ENDTAG and token[1] == 'head'):
+            return True
+    return False
+
+def get_page_tokens(url, until=None):
     headers = {}
     headers['User-Agent'] = 'feed-merger/1.0 +https://github.com/madewokherd/feed-merger'
     js, headers, response = fetch_http(url, headers=headers)
     data = response.read()
 
-    data_str = data.decode(js.get('http:charset', 'utf-8'), errors='replace')
+    data_str = data.decode(sniff_charset(data, headers.get_content_charset()), errors='replace')
+    if until is not None:
+        return tokenize(data_str, until)
+
     parser = HtmlTokenizer()
     parser.feed(data_str)
 
     return parser.tokens
 
-def handle_sgml(url, js, state, response):
-    data = response.read()
+def sniff_format(data_str):
+    # looks at the first meaningful token, returns 'html', 'rss', 'atom' or
+    # None, without tokenizing more of the document than it needs to. this
+    # has to see the document as written, so it always uses html.parser
+    parser = StdlibTokenizer()
+    checked = 0
+    for pos in range(0, len(data_str), TOKENIZE_CHUNK_SIZE):
+        parser.feed(data_str[pos:pos+TOKENIZE_CHUNK_SIZE])
+        for token_type, tag, tdata in parser.tokens[checked:]:
+            if token_type == DECL:
+                tag, rest = tag.split(' ', 1)
+                if tag.lower() == 'doctype':
+                    doctype = rest.split(' ', 1)[0]
+                    if doctype == 'html':
+                        return 'html'
+                    else:
+                        return None
+            elif token_type == STARTTAG:
+                if tag == 'html':
+                    return 'html'
+                elif tag == 'rss':
+                    return 'rss'
+                elif tag == 'feed':
+                    return 'atom'
+                else:
+                    return None
+            elif token_type == DATA and tag.strip():
+                return None
+        checked = len(parser.tokens)
+    return None
+
+# documents at least this big are parsed on parse_pool when it is set
+PARSE_IN_POOL_SIZE = 256 * 1024
+parse_pool = None
+
+def init_parse_worker(backend):
+    global tokenizer_backend
+    tokenizer_backend = backend
+
+def parse_document(data, header_charset, mimetype, prev_latest):
+    # the cpu bound part of handle_sgml, run in a parse worker. returns the
+    # kind, the parsed fields and the latest entry timestamp for feeds, or
+    # the charset the page was read with for html
+    charset = sniff_charset(data, header_charset)
+    data_str = data.decode(charset, errors='replace')
+
+    kind = sniff_format(data_str)
+    if kind is None and mimetype in ('text/html', 'text/xhtml+xml'):
+        kind = 'html'
+
+    if kind in ('rss', 'atom'):
+        feed, new_latest = parse_feed(data_str, kind, prev_latest.get(kind))
+        return kind, feed, new_latest
+
+    if kind == 'html':
+        parser = HtmlTokenizer()
+        parser.feed(data_str)
+        meta, charset, _data_str, _tokens = html_meta(data, data_str, parser.tokens, charset)
+        return kind, meta, charset
 
-    data_str = data.decode(js.get('http:charset', 'utf-8'), errors='replace')
-    parser = HtmlTokenizer()
-    parser.feed(data_str)
+    return kind, None, None
 
-    for token in parser.tokens:
-        token_type, tag, tdata = token
+def handle_sgml_in_pool(url, js, state, data):
+    prev_latest = {kind: state.get((kind, url, 'latest')) for kind in feed_formats}
+    kind, fields, extra = parse_pool.submit(parse_document, data, js.get('http:charset'),
+        js.get('http:mimetype'), prev_latest).result()
 
-        if token_type == DECL:
-            tag, rest = tag.split(' ', 1)
-            if tag.lower() == 'doctype':
-                doctype = rest.split(' ', 1)[0]
-                if doctype == 'html':
-                    return handle_html(url, js, state, data, data_str, parser.tokens)
-                else:
-                    break
-        elif token_type == STARTTAG:
-            if tag == 'html':
-                return handle_html(url, js, state, data, data_str, parser.tokens)
-            elif tag == 'rss':
-                return handle_rss(url, js, state, data, data_str, parser.tokens)
-            elif tag == 'feed':
-                return handle_atom(url, js, state, data, data_str, parser.tokens)
-            else:
-                break
-        elif token_type == DATA and tag.strip():
-            break
+    if kind in ('rss', 'atom'):
+        return finish_feed(url, js, state, kind, fields, extra)
 
-    if js.get('http:mimetype') in ('text/html', 'text/xhtml+xml'):
-        return handle_html(url, js, state, data, data_str, parser.tokens)
+    if kind == 'html':
+        js.update(fields)
+        return html_defaults(js, data.decode(extra, errors='replace'))
 
-    # Don't know how to parse this, just use the defaults
     js['fm:entries'] = [{}]
     return core.JSON, js
 
+def handle_sgml(url, js, state, response):
+    data = response.read()
+
+    # pages with a host handler need the tokens, so those stay here
+    if parse_pool is not None and len(data) >= PARSE_IN_POOL_SIZE and \
+        find_host_handler(url, html_host_handlers) is None:
+        return handle_sgml_in_pool(url, js, state, data)
+
+    charset = sniff_charset(data, js.get('http:charset'))
+    data_str = data.decode(charset, errors='replace')
+
+    kind = sniff_format(data_str)
+    if kind is None and js.get('http:mimetype') in ('text/html', 'text/xhtml+xml'):
+        kind = 'html'
+
+    if kind is None:
+        # Don't know how to parse this, just use the defaults
+        js['fm:entries'] = [{}]
+        return core.JSON, js
+
+    # feeds are parsed by their handlers, only html needs the tokens
+    if kind == 'rss':
+        return handle_rss(url, js, state, data, data_str, None)
+    elif kind == 'atom':
+        return handle_atom(url, js, state, data, data_str, None)
+
+    parser = HtmlTokenizer()
+    parser.feed(data_str)
+
+    return handle_html(url, js, state, data, data_str, parser.tokens, charset=charset)
+
 mimetype_handlers = {
     'text/html': handle_sgml,
     'text/xhtml+xml': handle_sgml,
@@ -943,25 +1475,36 @@ mimetype_handlers = {
 
 def fetch_html(url, *args, **kwargs):
     # returns json, tokens
-    js, headers, response = fetch_http(url, *args, **kwargs)
+    return html_from_response(url, *fetch_http(url, *args, **kwargs))
 
+def fetch_html_many(urls, *args, **kwargs):
+    # fetches the pages concurrently, returns a list of (json, tokens)
+    responses = fm_http.run(fm_http.gather(fetch_http_async(url, *args, **kwargs) for url in urls))
+    return [html_from_response(url, *response) for url, response in zip(urls, responses)]
+
+def html_from_response(url, js, headers, response):
     data = response.read()
-    data_str = data.decode('utf-8', errors='replace')
+    charset = sniff_charset(data, headers.get_content_charset())
+    data_str = data.decode(charset, errors='replace')
     parser = HtmlTokenizer()
     parser.feed(data_str)
 
-    _disposition, js = handle_html(url, js, {}, data, data_str, parser.tokens, False)
+    _disposition, js = handle_html(url, js, {}, data, data_str, parser.tokens, False, charset)
 
     fill_http_defaults(js)
 
     return js, parser.tokens
 
 def fetch_http(url, data=None, headers={}):
+    # returns json, headers, response
+    return fm_http.run(fetch_http_async(url, data, headers))
+
+async def fetch_http_async(url, data=None, headers={}):
     # returns json, headers, response
     req = urllib.request.Request(url, data=data, headers=headers)
 
     try:
-        response = urllib.request.urlopen(req)
+        response = await fm_http.fetch(req)
     except urllib.error.HTTPError as e:
         if e.code == 304:
             return None, e.headers, e.fp